@@ -0,0 +1,117 @@
+#
+#   Helper functions to archive raw waterfall lines, and read them back.
+#
+#   An archive file is a short fixed header followed by fixed-size records, one per
+#   waterfall line, so it can be appended to cheaply and memory-mapped for analysis.
+#
+import os.path
+import struct
+import time
+
+import numpy as np
+
+# magic, format version, center frequency (kHz), span (kHz), zoom, bins
+ARCHIVE_MAGIC = b"KIWIWF"
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = struct.Struct("<6sHIIII")
+
+
+def archive_dtype(bins):
+    """ Record layout of an archive: receive time (unix seconds), W/F sequence number and the raw line """
+    return np.dtype([('time', '<f8'), ('seq', '<u4'), ('spectrum', 'u1', (bins,))])
+
+
+def read_archive_header(filename):
+    """ Read the header of an archive file. Returns a dict, or None if this is not an archive """
+    _f = open(filename, 'rb')
+    _data = _f.read(ARCHIVE_HEADER.size)
+    _f.close()
+
+    if len(_data) < ARCHIVE_HEADER.size:
+        return None
+    _magic, _version, _center, _span, _zoom, _bins = ARCHIVE_HEADER.unpack(_data)
+    if _magic != ARCHIVE_MAGIC or _version != ARCHIVE_VERSION:
+        print("Not a waterfall archive file!")
+        return None
+
+    return {
+        'center': _center,
+        'span': _span,
+        'zoom': _zoom,
+        'bins': _bins,
+        'lower': _center - _span/2,
+        'upper': _center + _span/2
+    }
+
+
+class WaterfallArchive(object):
+    """ Appends raw uint8 waterfall lines to an archive file.
+
+    The header is written when the file is created. An existing file is only
+    appended to if it was created for the same window.
+    """
+
+    def __init__(self, filename, window):
+        self.filename = filename
+        self.bins = window['bins']
+
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            _header = read_archive_header(filename)
+            if _header is None or (_header['center'], _header['span'], _header['bins']) != (window['center'], window['span'], self.bins):
+                raise ValueError("Archive %s was created for a different window" % filename)
+            self._file = open(filename, 'ab')
+            # Drop any partial record left by an interrupted write
+            _dtype = archive_dtype(self.bins)
+            _extra = (os.path.getsize(filename) - ARCHIVE_HEADER.size) % _dtype.itemsize
+            if _extra:
+                self._file.truncate(os.path.getsize(filename) - _extra)
+        else:
+            self._file = open(filename, 'wb')
+            self._file.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, int(window['center']),
+                int(window['span']), window['zoom'], self.bins))
+
+        # Reused for every line, so nothing is allocated per record
+        self._record = np.zeros(1, dtype=archive_dtype(self.bins))
+        self._record_view = memoryview(self._record).cast('B')
+
+    def write(self, line, seq, timestamp=None):
+        """ Append one raw waterfall line, stamped with the current time unless a timestamp is given """
+        self._record['time'] = time.time() if timestamp is None else timestamp
+        self._record['seq'] = seq
+        self._record['spectrum'][0] = line
+        self._file.write(self._record_view)
+
+    def close(self):
+        self._file.close()
+
+
+def read_archive(filename):
+    """ Memory-map an archive file. Returns (header, records), or None if this is not an archive.
+
+    records is a structured array with 'time', 'seq' and 'spectrum' fields, where
+    records['spectrum'] is a (lines, bins) uint8 array. Only the pages actually
+    used are read from disk.
+    """
+    _header = read_archive_header(filename)
+    if _header is None:
+        return None
+
+    _dtype = archive_dtype(_header['bins'])
+    # Ignore a partial record at the end, e.g. from a capture still being written
+    _lines = (os.path.getsize(filename) - ARCHIVE_HEADER.size) // _dtype.itemsize
+    if _lines == 0:
+        return _header, np.zeros(0, dtype=_dtype)
+
+    return _header, np.memmap(filename, dtype=_dtype, mode='r', offset=ARCHIVE_HEADER.size, shape=(_lines,))
+
+
+def replay_archive(records, accumulator, start_time=None, end_time=None):
+    """ Fold the archived lines between two unix times into a WaterfallAccumulator. Returns the number of lines used """
+    # Lines are archived in the order they arrived, so the times are sorted
+    _start = 0 if start_time is None else np.searchsorted(records['time'], start_time, side='left')
+    _end = len(records) if end_time is None else np.searchsorted(records['time'], end_time, side='right')
+
+    for _line in records['spectrum'][_start:_end]:
+        accumulator.add(_line)
+
+    return max(0, _end - _start)
@@ -0,0 +1,574 @@
+"""
+Capture waterfall data from many KiwiSDRs concurrently from a single process.
+
+Each receiver gets its own websocket, driven from one asyncio event loop, and
+its RRD and spectra outputs are written exactly as snrtorrd.py would.
+
+Receiver list format - one receiver per line, blank lines and # comments ignored:
+    hostname port [password] [spectra_file]
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+
+import numpy as np
+
+from kiwi_helpers import *
+from snr_helpers import *
+
+import mod_pywebsocket.common
+from mod_pywebsocket.stream import ConnectionTerminatedException
+
+
+def read_receiver_list(filename):
+    """ Read in the receiver list file. Returns a list of dicts """
+    _receivers = []
+    _f = open(filename, 'r')
+    for line in _f:
+        _fields = line.split('#')[0].split()
+        if len(_fields) == 0:
+            continue
+
+        _receivers.append({
+            'host': _fields[0],
+            'port': int(_fields[1]) if len(_fields) > 1 else DEFAULT_PORT,
+            'password': _fields[2] if len(_fields) > 2 else 'NONE',
+            'spectra': _fields[3] if len(_fields) > 3 else 'none'
+        })
+    _f.close()
+    return _receivers
+
+
+def receiver_name(receiver):
+    """ Name for a receiver in the logs: the host, plus the port if it isn't the default """
+    if receiver['port'] != DEFAULT_PORT:
+        return f"{receiver['host']}:{receiver['port']}"
+    return receiver['host']
+
+
+def capture_limits(options):
+    """ Returns (length, required): the most lines to capture, and the fewest that make a good capture """
+    if options.adaptive > 0:
+        # Capture until the statistics settle, within the min/max bounds
+        return options.max_length, options.min_length
+    return options.length, options.length
+
+
+def new_accumulator(window, options):
+    """ WaterfallAccumulator for one capture window """
+    return WaterfallAccumulator(window['bins'], histogram=len(options.percentiles) > 0,
+        linear=options.linear, variance=options.adaptive > 0)
+
+
+def make_dispatcher(window, options, logger):
+    """ Message dispatcher for a receiver. W/F messages come back as (sequence number, raw uint8 waterfall line), everything else as None """
+
+    def _waterfall_line(body, header):
+        if len(header) < WF_HEADER_LEN:
+            return None
+        if options.compress:
+            return get_waterfall_seq(header), decode_waterfall_adpcm(body, window['bins'])
+        if len(body) < window['bins']:
+            return None
+        return get_waterfall_seq(header), np.frombuffer(body, dtype='B', count=window['bins'])
+
+    def _status_message(body, header):
+        logger.debug("Server message: %s" % bytes(body).decode('utf-8', 'replace'))
+        # Raises KiwiServerError straight away if we are being turned away
+        check_status_message(body)
+
+    _dispatcher = MessageDispatcher()
+    _dispatcher.register(WF_TAG, _waterfall_line, WF_HEADER_LEN)
+    _dispatcher.register(MSG_TAG, _status_message)
+    return _dispatcher
+
+
+def capture_done(accumulator, count, length, required, options):
+    """ True once a capture has all the lines it needs """
+    if count >= length:
+        return True
+    return (options.adaptive > 0 and count >= required and count % WF_CONVERGENCE_CHECK == 0
+        and snr_converged(accumulator, options.adaptive, options.linear))
+
+
+class FleetReceiver(object):
+    """ One KiwiSDR in the fleet, with its own connection and capture schedule """
+
+    def __init__(self, receiver, options, connect_limit):
+        self.host = receiver['host']
+        self.port = receiver['port']
+        self.password = receiver['password']
+        self.spectra = receiver['spectra']
+        self.options = options
+
+        self._connect_limit = connect_limit
+        self._logger = logging.getLogger(f"kiwi_fleet.{receiver_name(receiver)}")
+
+        self.window = calculate_span(options.zoom, options.offset)
+        self.snrfile = get_rrd_name(self.host, self.window, self.port) + ".rrd"
+        self.bands = BandSegments(options.bands, self.window)
+        self._dispatcher = make_dispatcher(self.window, options, self._logger)
+
+        self._stream = None
+        self._queue = None
+        self._reader_task = None
+
+    async def connect(self):
+        """ Open the websocket and start the waterfall """
+        async with self._connect_limit:
+            self._stream = await open_async_stream(self.host, self.port, self.options.timeout)
+
+        self._queue = asyncio.Queue()
+        self._reader_task = asyncio.ensure_future(self._read_messages(self._stream))
+
+        for msg in get_setup_messages(self.password, self.window['zoom'], self.window['offset'], self.options.compress):
+            await self.send_message(msg)
+
+    async def _read_messages(self, stream):
+        """ Pull messages off the stream and queue them up. None is queued when the connection ends
+
+        Reading happens in its own task, so a receive timeout never abandons a frame half read.
+        """
+        try:
+            while True:
+                message = await stream.receive_message()
+                if message is None:
+                    break
+                self._queue.put_nowait(message)
+        except ConnectionTerminatedException as e:
+            self._logger.debug(f"Connection ended: {e}")
+        except Exception as e:
+            self._logger.error(f"Receive error: {e!r}")
+        self._queue.put_nowait(None)
+
+    async def send_message(self, msg):
+        await self._stream.send_message(msg)
+
+    async def shutdown(self):
+        """ Close the connection cleanly, telling the Kiwi we are going away """
+        if self._stream:
+            try:
+                await self._stream.close_connection(mod_pywebsocket.common.STATUS_GOING_AWAY, wait_response=False)
+            except Exception as e:
+                self._logger.debug(f"Close failed: {e!r}")
+        self.close()
+
+    def close(self):
+        """ Drop the connection straight away, e.g. after an error """
+        if self._reader_task:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._stream:
+            self._stream.abort_connection()
+            self._stream = None
+
+    async def receive_message(self, timeout):
+        """ Next message from the server, None if the connection has closed """
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+    async def capture(self):
+        """ Gather one capture window. Returns a WaterfallAccumulator, or None if we did not get enough lines """
+        length, required = capture_limits(self.options)
+        accumulator = new_accumulator(self.window, self.options)
+        tracker = SequenceTracker(self.options.reject_stale)
+        count = 0
+        while count < length:
+            try:
+                tmp = await self.receive_message(self.options.timeout)
+            except asyncio.TimeoutError:
+                self._logger.error("Timeout waiting for data!")
+                break
+
+            if tmp is None:
+                self._logger.error("Server closed the connection!")
+                break
+
+            line = self._dispatcher.dispatch(tmp)
+            if line is not None and tracker.check(line[0]):
+                accumulator.add(line[1])
+                count += 1
+                if capture_done(accumulator, count, length, required, self.options):
+                    break
+
+        self._logger.debug("Sequence: %s" % tracker.summary())
+
+        if count < required:
+            self._logger.error("Did not gather all required samples, abandoning.")
+            if self.spectra != 'none':
+                append_dummy_entry(self.spectra, self.window['lower'], self.window['upper'], self.window['bins'])
+            return None
+
+        return accumulator
+
+    async def idle(self, until):
+        """ Drain server chatter and send keepalives until the next capture is due.
+
+        Messages still go through the dispatcher, so a status message turning us away
+        raises KiwiServerError straight away.
+        """
+        while True:
+            _remaining = until - time.time()
+            if _remaining <= 0:
+                return True
+            await self.send_message('SET keepalive')
+            _deadline = time.time() + min(_remaining, self.options.keepalive)
+            while True:
+                _wait = _deadline - time.time()
+                if _wait <= 0:
+                    break
+                try:
+                    _message = await self.receive_message(_wait)
+                except asyncio.TimeoutError:
+                    break
+                if _message is None:
+                    return False
+                self._dispatcher.dispatch(_message)
+
+    async def run(self, start_time):
+        """ Capture once, or every timestep seconds in daemon mode """
+        create_rrd(self.snrfile, self.options.step)
+        if len(self.bands) > 0:
+            create_band_rrd(get_band_rrd_name(self.snrfile), self.options.step, self.bands.names)
+
+        _next_capture = start_time
+        await asyncio.sleep(max(0, start_time - time.time()))
+        while True:
+            try:
+                if self._stream is None:
+                    await self.connect()
+                else:
+                    # Drop anything left over from before the waterfall was paused, but not status messages.
+                    while not self._queue.empty():
+                        _message = self._queue.get_nowait()
+                        if _message is None:
+                            raise ConnectionError("connection closed while idle")
+                        self._dispatcher.dispatch(_message)
+                    await self.send_message('SET wf_speed=%d' % WF_SPEED_MAX)
+
+                accumulator = await self.capture()
+                if accumulator is None:
+                    self.close()
+                else:
+                    self._logger.info("Captured %d lines" % accumulator.count)
+                    write_results(self.snrfile, self.spectra, self.window, accumulator, self.options.percentiles, self.options.linear, self.bands)
+            except KiwiServerError as e:
+                self._logger.error(f"Server turned us away: {e}")
+                self.close()
+                if e.reason == KIWI_BAD_PASSWORD:
+                    # Retrying won't help
+                    return
+            except Exception as e:
+                self._logger.error(f"Capture failed: {e!r}")
+                self.close()
+
+            if not self.options.daemon:
+                await self.shutdown()
+                return
+
+            # Schedule on a fixed grid, skipping any slots we overran.
+            _next_capture += self.options.step
+            while _next_capture < time.time():
+                _next_capture += self.options.step
+
+            if self._stream is None:
+                await asyncio.sleep(_next_capture - time.time())
+                continue
+
+            try:
+                await self.send_message('SET wf_speed=%d' % WF_SPEED_OFF)
+                if not await self.idle(_next_capture):
+                    self._logger.info("Server closed the connection, reconnecting.")
+                    self.close()
+            except KiwiServerError as e:
+                self._logger.error(f"Server turned us away: {e}")
+                self.close()
+                if e.reason == KIWI_BAD_PASSWORD:
+                    return
+            except Exception as e:
+                self._logger.error(f"Connection lost while idle: {e!r}")
+                self.close()
+
+            if self._stream is None:
+                # Reconnect at the next slot rather than straight away
+                await asyncio.sleep(max(0, _next_capture - time.time()))
+
+
+async def run_fleet(receivers, options):
+    _connect_limit = asyncio.Semaphore(options.max_connect)
+    _start = time.time()
+    _tasks = []
+    for _i, _receiver in enumerate(receivers):
+        _fleet_rx = FleetReceiver(_receiver, options, _connect_limit)
+        # Spread the receivers across the first part of the timestep so they
+        # don't all hit the network (and the RRD files) at once.
+        _offset = (_i * options.stagger) % max(options.step, 1)
+        _tasks.append(_fleet_rx.run(_start + _offset))
+
+    # One receiver failing must never take the others down with it
+    for _receiver, _result in zip(receivers, await asyncio.gather(*_tasks, return_exceptions=True)):
+        if isinstance(_result, Exception):
+            logging.getLogger(f"kiwi_fleet.{receiver_name(_receiver)}").error(f"Receiver stopped: {_result!r}")
+
+
+class PolledFleetReceiver(object):
+    """ One KiwiSDR in the fleet, serviced by a selectors based Poller instead of asyncio.
+
+    The receiver is a small state machine: waiting for its next capture with no
+    connection, connecting (the connect and handshake run in the poller), capturing,
+    or paused between captures with the connection held open.
+    """
+    WAITING = 0
+    CONNECTING = 1
+    CAPTURING = 2
+    PAUSED = 3
+    DONE = 4
+
+    def __init__(self, receiver, options, poller, start_time):
+        self.host = receiver['host']
+        self.port = receiver['port']
+        self.password = receiver['password']
+        self.spectra = receiver['spectra']
+        self.options = options
+
+        self._poller = poller
+        self._logger = logging.getLogger(f"kiwi_fleet.{receiver_name(receiver)}")
+
+        self.window = calculate_span(options.zoom, options.offset)
+        self.snrfile = get_rrd_name(self.host, self.window, self.port) + ".rrd"
+        self.bands = BandSegments(options.bands, self.window)
+        self._dispatcher = make_dispatcher(self.window, options, self._logger)
+
+        create_rrd(self.snrfile, self.options.step)
+        if len(self.bands) > 0:
+            create_band_rrd(get_band_rrd_name(self.snrfile), self.options.step, self.bands.names)
+
+        self.state = self.WAITING
+        self._stream = None
+        self._next_capture = start_time
+        self._next_keepalive = 0
+        self._deadline = 0
+
+        self._accumulator = None
+        self._tracker = None
+        self._count = 0
+        self._length, self._required = capture_limits(options)
+
+    def next_event(self):
+        """ Time of the next thing this receiver has to do, other than handle incoming data """
+        if self.state in (self.CONNECTING, self.CAPTURING):
+            return self._deadline
+        if self.state == self.PAUSED:
+            return min(self._next_capture, self._next_keepalive)
+        return self._next_capture
+
+    def service(self, now):
+        """ Start captures, time them out and send keepalives as they fall due """
+        if self.state == self.WAITING and now >= self._next_capture:
+            try:
+                # Only the name lookup blocks, the poller finishes the connect and handshake.
+                self._stream = open_polled_stream(self.host, self.port)
+            except Exception as e:
+                self._logger.error(f"Failed to connect: {e!r}")
+                self._schedule_next()
+                return
+            # These are held back until the handshake is done
+            for msg in get_setup_messages(self.password, self.window['zoom'], self.window['offset'], self.options.compress):
+                self._stream.send_message(msg)
+            self.state = self.CONNECTING
+            self._deadline = now + self.options.timeout
+            self._poller.register(self._stream, self.on_message)
+
+        elif self.state == self.CONNECTING and not self._stream.handshaking:
+            self._start_capture(now)
+
+        elif self.state == self.CONNECTING and now >= self._deadline:
+            self._logger.error("Timeout connecting!")
+            self._disconnect()
+            self._schedule_next()
+
+        elif self.state == self.PAUSED and now >= self._next_capture:
+            self._stream.send_message('SET wf_speed=%d' % WF_SPEED_MAX)
+            self._start_capture(now)
+
+        elif self.state == self.PAUSED and now >= self._next_keepalive:
+            self._stream.send_message('SET keepalive')
+            self._next_keepalive = now + self.options.keepalive
+
+        elif self.state == self.CAPTURING and now >= self._deadline:
+            self._logger.error("Timeout waiting for data!")
+            self._finish_capture()
+
+    def on_message(self, message):
+        """ Called by the poller with each message from the server, or None when the connection closes """
+        # A paused receiver already has its next capture scheduled
+        _capturing = self.state in (self.CONNECTING, self.CAPTURING)
+        try:
+            self._handle_message(message)
+        except KiwiServerError as e:
+            self._logger.error(f"Server turned us away: {e}")
+            self._disconnect()
+            if _capturing:
+                self._schedule_next()
+            if e.reason == KIWI_BAD_PASSWORD:
+                # Retrying won't help
+                self.state = self.DONE
+        except Exception as e:
+            # Keep one bad receiver from taking down the whole loop
+            self._logger.error(f"Capture failed: {e!r}")
+            self._disconnect()
+            if _capturing:
+                self._schedule_next()
+
+    def _handle_message(self, message):
+        if message is None:
+            if self.state == self.CONNECTING:
+                self._logger.error("Failed to connect!")
+                self._disconnect()
+                self._schedule_next()
+            elif self.state == self.CAPTURING:
+                self._logger.error("Server closed the connection!")
+                self._finish_capture()
+            elif self.state == self.PAUSED:
+                self._logger.info("Server closed the connection, reconnecting.")
+                self._disconnect()
+            return
+
+        if self.state == self.CONNECTING:
+            # Came in with the handshake response, before service() noticed the handshake was done
+            self._start_capture(time.time())
+
+        line = self._dispatcher.dispatch(message)
+        if self.state != self.CAPTURING:
+            # Stale lines from before the waterfall was paused. Status messages have been checked.
+            return
+
+        if line is None or not self._tracker.check(line[0]):
+            return
+
+        self._accumulator.add(line[1])
+        self._count += 1
+        self._deadline = time.time() + self.options.timeout
+        if capture_done(self._accumulator, self._count, self._length, self._required, self.options):
+            self._finish_capture()
+
+    def _start_capture(self, now):
+        self.state = self.CAPTURING
+        self._accumulator = new_accumulator(self.window, self.options)
+        self._tracker = SequenceTracker(self.options.reject_stale)
+        self._count = 0
+        self._deadline = now + self.options.timeout
+
+    def _finish_capture(self):
+        """ Write out the results of a capture (good or not), then pause or disconnect until the next one """
+        self._logger.debug("Sequence: %s" % self._tracker.summary())
+        if self._count < self._required:
+            self._logger.error("Did not gather all required samples, abandoning.")
+            if self.spectra != 'none':
+                append_dummy_entry(self.spectra, self.window['lower'], self.window['upper'], self.window['bins'])
+            self._disconnect()
+        else:
+            self._logger.info("Captured %d lines" % self._count)
+            write_results(self.snrfile, self.spectra, self.window, self._accumulator, self.options.percentiles, self.options.linear, self.bands)
+            if self.options.daemon and not self._stream.closed:
+                self._stream.send_message('SET wf_speed=%d' % WF_SPEED_OFF)
+                self.state = self.PAUSED
+                self._next_keepalive = 0
+            else:
+                self._disconnect()
+
+        self._accumulator = None
+        self._schedule_next()
+
+    def _disconnect(self):
+        if self._stream is not None:
+            self._poller.unregister(self._stream)
+            self._stream.close()
+            self._stream = None
+        self.state = self.WAITING
+
+    def _schedule_next(self):
+        if not self.options.daemon:
+            self._disconnect()
+            self.state = self.DONE
+            return
+
+        # Schedule on a fixed grid, skipping any slots we overran.
+        self._next_capture += self.options.step
+        while self._next_capture < time.time():
+            self._next_capture += self.options.step
+
+
+def run_fleet_poller(receivers, options):
+    """ Run the whole fleet from one thread, with a selectors based poller instead of asyncio """
+    _poller = Poller()
+    _start = time.time()
+    _fleet = []
+    for _i, _receiver in enumerate(receivers):
+        _offset = (_i * options.stagger) % max(options.step, 1)
+        _fleet.append(PolledFleetReceiver(_receiver, options, _poller, _start + _offset))
+
+    while True:
+        _active = [_rx for _rx in _fleet if _rx.state != PolledFleetReceiver.DONE]
+        if len(_active) == 0:
+            break
+
+        _now = time.time()
+        for _rx in _active:
+            _rx.service(_now)
+
+        # Wait for data, but no longer than until the next receiver has something to do
+        _pending = [_rx.next_event() for _rx in _fleet if _rx.state != PolledFleetReceiver.DONE]
+        if _pending:
+            _poller.poll(max(0, min(_pending) - time.time()))
+
+    _poller.close()
+
+
+def main():
+    # Read command-line arguments
+    parser = argparse.ArgumentParser(description="KiwiSDR Fleet Capture", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('receivers', type=str, help="Receiver list file (hostname port [password] [spectra_file] per line)")
+    parser.add_argument("-l", "--length", type=int, default=100, help="How many samples to draw from each server")
+    parser.add_argument("-t", "--timestep", type=int, dest="step", default=300, help="Expected timestep between samples")
+    parser.add_argument("--timeout", type=float, default=5, help="Connection Timeout")
+    parser.add_argument("-z", "--zoom", type=int, default=0, help="Zoom factor")
+    parser.add_argument("-o", "--offset", type=int, default=0, help="Start frequency in kHz")
+    parser.add_argument("--percentiles", type=parse_percentiles, default='none', help="Comma separated per-bin time-percentiles to save with the spectra, e.g. 10,90")
+    parser.add_argument("--linear", action="store_true", default=False, help="Average the spectra in the linear power domain rather than in dB")
+    parser.add_argument("--compress", action="store_true", default=False, help="Request the compressed (ADPCM) waterfall to save bandwidth")
+    parser.add_argument("--bands", type=parse_bands, default='none', help="Also record SNR for these bands: a preset (ham, broadcast) and/or name:lower-upper kHz entries, comma separated")
+    parser.add_argument("--reject_stale", action="store_true", default=False, help="Discard repeated or out of order waterfall lines (only if the sequence number advances per line)")
+    parser.add_argument("--adaptive", type=float, default=0, help="Stop capturing once the median and p95 are known to within this many dB (95%% confidence). 0 disables.")
+    parser.add_argument("--min_length", type=int, default=20, help="Minimum number of samples in an adaptive capture")
+    parser.add_argument("--max_length", type=int, default=1000, help="Maximum number of samples in an adaptive capture")
+    parser.add_argument("-d", "--daemon", action="store_true", default=False, help="Keep connections open and capture every TIMESTEP seconds")
+    parser.add_argument("--keepalive", type=float, default=5, help="Seconds between keepalives while idle in daemon mode")
+    parser.add_argument("--max_connect", type=int, default=20, help="Maximum number of connections being set up at once")
+    parser.add_argument("--stagger", type=float, default=0.5, help="Seconds between the start of each receiver's capture")
+    parser.add_argument("--poller", action="store_true", default=False, help="Service the receivers with a selectors (epoll) loop rather than asyncio")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False, help="Verbose output (set logging level to DEBUG)")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging_level = logging.DEBUG
+    else:
+        logging_level = logging.INFO
+
+    # Set up logging
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging_level)
+
+    _receivers = read_receiver_list(args.receivers)
+    if len(_receivers) == 0:
+        print("No receivers in list!")
+        sys.exit(1)
+
+    if args.poller:
+        run_fleet_poller(_receivers, args)
+    else:
+        asyncio.run(run_fleet(_receivers, args))
+
+
+if __name__ == "__main__":
+    main()
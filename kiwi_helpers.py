@@ -0,0 +1,487 @@
+#
+#   Helper functions to talk to a KiwiSDR waterfall stream.
+#
+import asyncio
+import errno
+import os
+import socket
+import struct
+import time
+import urllib.parse
+
+import numpy as np
+
+import wsclient
+
+import mod_pywebsocket.common
+from mod_pywebsocket.stream import AsyncStream
+from mod_pywebsocket.stream import Stream
+from mod_pywebsocket.stream import StreamOptions
+
+from poller_helpers import *
+from waterfall_helpers import *
+
+# Each W/F message starts with a 16 byte header ('W/F', a pad byte, x_bin, flags/zoom and sequence)
+WF_HEADER_LEN = 16
+
+# W/F header layout: tag, pad byte, x_bin, flags (high 16 bits) / zoom (low 16 bits), sequence number
+WF_HEADER = struct.Struct('<3sxIII')
+
+# Kiwi server messages start with a 3 byte tag
+KIWI_TAG_LENGTH = 3
+WF_TAG = b"W/F"
+MSG_TAG = b"MSG"
+SND_TAG = b"SND"
+
+# Compressed waterfall lines are IMA ADPCM, with this many padding samples ahead of the bins
+ADPCM_PAD = 10
+
+# IMA ADPCM tables
+_ADPCM_STEP_SIZE = [
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767]
+_ADPCM_INDEX_ADJUST = [-1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8]
+
+
+def _adpcm_tables():
+    """ Precompute the signed difference and next step index for every (step index, code) pair,
+    and the step index after a whole byte (low nibble then high nibble) for every (step index, byte) pair """
+    _step = np.array(_ADPCM_STEP_SIZE, dtype=np.int32)[:, None]
+    _code = np.arange(16)[None, :]
+
+    _diff = (_step >> 3) + np.where(_code & 1, _step >> 2, 0) + np.where(_code & 2, _step >> 1, 0) + np.where(_code & 4, _step, 0)
+    _diff = np.where(_code & 8, -_diff, _diff)
+
+    _next = np.clip(np.arange(len(_ADPCM_STEP_SIZE))[:, None] + np.array(_ADPCM_INDEX_ADJUST)[None, :], 0, len(_ADPCM_STEP_SIZE) - 1)
+
+    _byte = np.arange(256)
+    _next_byte = _next[_next[:, _byte & 0x0f], _byte >> 4]
+
+    return _diff, _next, _next_byte.tolist()
+
+_ADPCM_DIFF, _ADPCM_NEXT, _ADPCM_NEXT_BYTE = _adpcm_tables()
+
+
+def decode_waterfall_adpcm(data, bins, out=None):
+    """ Decode a compressed (wf_comp=1) waterfall payload back to bins uint8 values.
+
+    Each line is a fresh IMA ADPCM stream, low nibble first, with ADPCM_PAD samples of padding.
+    The step index walk is sequential, but goes a byte at a time through a per-byte table;
+    the differences are then looked up and summed with numpy.
+    """
+    _bytes = np.frombuffer(data, dtype=np.uint8)
+    _codes = np.empty(len(_bytes)*2, dtype=np.intp)
+    _codes[0::2] = _bytes & 0x0f
+    _codes[1::2] = _bytes >> 4
+
+    if len(_codes) < ADPCM_PAD + bins:
+        raise ValueError("Compressed waterfall line too short (%d samples)" % len(_codes))
+
+    # Walk the step index at the start of each byte. This is the only sequential part of the decode.
+    _start = []
+    _append = _start.append
+    _i = 0
+    _next_byte = _ADPCM_NEXT_BYTE
+    for _b in _bytes.tolist():
+        _append(_i)
+        _i = _next_byte[_i][_b]
+
+    # The index for each high nibble follows from the one for its low nibble
+    _index = np.empty(len(_codes), dtype=np.intp)
+    _index[0::2] = _start
+    _index[1::2] = _ADPCM_NEXT[_index[0::2], _codes[0::2]]
+
+    _values = np.cumsum(_ADPCM_DIFF[_index, _codes])
+
+    if _values.min() < -32768 or _values.max() > 32767:
+        # The predictor saturated somewhere, so the running sum needs clamping as it goes.
+        _prev = 0
+        for _k, _d in enumerate(_ADPCM_DIFF[_index, _codes].tolist()):
+            _prev = min(max(_prev + _d, -32768), 32767)
+            _values[_k] = _prev
+
+    if out is None:
+        out = np.empty(bins, dtype=np.uint8)
+    # Small overshoots from the encoder are clipped rather than wrapped.
+    np.clip(_values[ADPCM_PAD:ADPCM_PAD + bins], 0, 255, out=out, casting='unsafe')
+    return out
+
+
+# Reasons a Kiwi turns a connection away, as reported in its MSG status messages
+KIWI_TOO_BUSY = 'too_busy'
+KIWI_BAD_PASSWORD = 'bad_password'
+KIWI_REDIRECT = 'redirect'
+KIWI_DOWN = 'down'
+
+
+class KiwiServerError(Exception):
+    """ The Kiwi refused or dropped the connection. reason is one of the KIWI_* codes """
+
+    def __init__(self, reason, detail=''):
+        super(KiwiServerError, self).__init__("%s %s" % (reason, detail) if detail else reason)
+        self.reason = reason
+        self.detail = detail
+
+
+def parse_kiwi_msg(body):
+    """ Parse the body of a MSG message ('name=value name2=value2 ...') into a dict. Values are left as strings """
+    _params = {}
+    for _field in bytes(body).decode('utf-8', 'replace').split(' '):
+        if not _field:
+            continue
+        _name, _sep, _value = _field.partition('=')
+        _params[_name] = _value
+    return _params
+
+
+def kiwi_msg_reason(params):
+    """ Returns (reason, detail) if the status parameters mean the connection is being turned away, otherwise None """
+    if 'too_busy' in params:
+        return KIWI_TOO_BUSY, params['too_busy']
+    if params.get('badp') == '1':
+        return KIWI_BAD_PASSWORD, ''
+    if 'redirect' in params:
+        return KIWI_REDIRECT, urllib.parse.unquote(params['redirect'])
+    if 'down' in params:
+        return KIWI_DOWN, params['down']
+    return None
+
+
+def check_status_message(body, header=None):
+    """ MSG handler that parses the status message, and raises KiwiServerError straight away if
+    the Kiwi is busy, down, redirecting us or has rejected the password. Returns the parameters otherwise.
+    """
+    _params = parse_kiwi_msg(body)
+    _reason = kiwi_msg_reason(_params)
+    if _reason is not None:
+        raise KiwiServerError(*_reason)
+    return _params
+
+
+class MessageDispatcher(object):
+    """ Routes Kiwi server messages to handlers by the 3 byte tag at the start of the message.
+
+    Each handler is called with a memoryview of the message body (after its header) and
+    one of the header itself, and dispatch returns whatever the handler returns.
+    Messages with no registered handler go to the default handler, if there is one.
+    """
+
+    def __init__(self, default=None):
+        self._handlers = {}
+        self._header_lengths = {}
+        self.default = default
+
+    def register(self, tag, handler, header_length=None):
+        """ Register a handler for a tag. By default the header is the tag and the space after it """
+        self._handlers[tag] = handler
+        self._header_lengths[tag] = KIWI_TAG_LENGTH + 1 if header_length is None else header_length
+
+    def dispatch(self, message):
+        """ Pass one message (bytes, or str for text frames) to its handler """
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        _view = memoryview(message)
+        _tag = bytes(_view[:KIWI_TAG_LENGTH])
+        _handler = self._handlers.get(_tag)
+        if _handler is None:
+            if self.default is None:
+                return None
+            return self.default(_view, _view[:0])
+        _header_length = self._header_lengths[_tag]
+        return _handler(_view[_header_length:], _view[:_header_length])
+
+
+def decode_waterfall_header(header):
+    """ Decode the 16 byte W/F header into a dict of x_bin, zoom, flags and seq """
+    _tag, _x_bin, _flags_zoom, _seq = WF_HEADER.unpack_from(header)
+    return {
+        'x_bin': _x_bin,
+        'zoom': _flags_zoom & 0xffff,
+        'flags': _flags_zoom >> 16,
+        'seq': _seq
+    }
+
+
+def get_waterfall_seq(header):
+    """ Just the sequence number from a W/F header """
+    return WF_HEADER.unpack_from(header)[3]
+
+
+# Lines to watch before trusting the sequence number to advance once per line
+SEQ_CHECK_LINES = 10
+
+
+class SequenceTracker(object):
+    """ Follows the W/F sequence numbers over a capture, counting dropped, repeated and stale lines.
+
+    With reject=True, check() tells the caller to discard repeated and stale (older than the
+    newest seen) lines, so delayed frames don't reach the reducer. Nothing is rejected until
+    the first SEQ_CHECK_LINES lines show the sequence number advancing with most lines; if it
+    doesn't (e.g. the server is using it to keep the waterfall in step with audio) rejection
+    stays off for the capture and summary() says so.
+    """
+
+    def __init__(self, reject=False):
+        self.reject = reject
+        self.reset()
+
+    def reset(self):
+        self.lines = 0
+        self.dropped = 0
+        self.repeated = 0
+        self.stale = 0
+        self.advances = 0
+        self.per_line = None
+        self.last_seq = None
+        self.first_time = None
+        self.last_time = None
+
+    def check(self, seq, now=None):
+        """ Account for one line. Returns False if the line should be rejected """
+        now = time.time() if now is None else now
+        if self.first_time is None:
+            self.first_time = now
+        self.last_time = now
+        self.lines += 1
+
+        _accept = True
+        if self.last_seq is None:
+            self.last_seq = seq
+        elif seq > self.last_seq:
+            self.dropped += seq - self.last_seq - 1
+            self.advances += 1
+            self.last_seq = seq
+        else:
+            if seq == self.last_seq:
+                self.repeated += 1
+            else:
+                self.stale += 1
+            _accept = not (self.reject and self.per_line)
+
+        if self.per_line is None and self.lines >= SEQ_CHECK_LINES:
+            self.per_line = self.advances >= (self.lines - 1) // 2
+        return _accept
+
+    def lines_per_second(self):
+        if self.lines < 2 or self.last_time <= self.first_time:
+            return 0.0
+        return (self.lines - 1) / (self.last_time - self.first_time)
+
+    def drop_rate(self):
+        """ Fraction of the lines the server sent that we never saw """
+        _expected = self.lines + self.dropped
+        return self.dropped / _expected if _expected else 0.0
+
+    def summary(self):
+        _summary = "%d lines at %.2f lines/s, %d dropped (%.1f%%), %d repeated, %d stale" % (
+            self.lines, self.lines_per_second(), self.dropped, 100*self.drop_rate(), self.repeated, self.stale)
+        if self.per_line is False:
+            _summary += " (sequence number doesn't advance per line%s)" % (", nothing rejected" if self.reject else "")
+        return _summary
+
+
+# Number of raw waterfall lines kept in the receive ring buffer
+WF_RING_SIZE = 16
+
+# How often (in lines) to test for convergence in an adaptive capture
+WF_CONVERGENCE_CHECK = 10
+
+# Waterfall speed used while capturing. 0 stops the waterfall between captures.
+WF_SPEED_MAX = 4
+WF_SPEED_OFF = 0
+
+
+def get_resource():
+    """ Websocket resource for the waterfall stream """
+    return '/%d/%s' % (int(time.time()), 'W/F')
+
+
+def open_stream(host, port, timeout):
+    """ Connect to a KiwiSDR, perform the websocket handshake and return (socket, stream) """
+    mysocket = socket.socket()
+    mysocket.connect((host, port))
+    mysocket.settimeout(timeout)
+
+    handshake = wsclient.ClientHandshakeProcessor(mysocket, host, port)
+    _leftover = handshake.handshake(get_resource())
+
+    # Any frames that arrived along with the handshake response are read first
+    request = wsclient.ClientRequest(mysocket, _leftover)
+    request.ws_version = mod_pywebsocket.common.VERSION_HYBI13
+
+    stream_option = StreamOptions()
+    stream_option.mask_send = True
+    stream_option.unmask_receive = False
+
+    mystream = Stream(request, stream_option)
+
+    return mysocket, mystream
+
+
+def open_polled_stream(host, port):
+    """ Start a non-blocking connect to a KiwiSDR, with the websocket handshake request queued behind it.
+
+    Only the name lookup blocks. The returned PolledStream finishes the connect and handshake
+    once it is registered with a Poller, and closes (its callback gets None) if either fails.
+    """
+    _family, _type, _proto, _, _address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+    mysocket = socket.socket(_family, _type, _proto)
+    mysocket.setblocking(False)
+    _error = mysocket.connect_ex(_address)
+    if _error not in (0, errno.EINPROGRESS):
+        mysocket.close()
+        raise OSError(_error, os.strerror(_error))
+
+    handshake = wsclient.ClientHandshakeProcessor(None, host, port)
+    stream = PolledStream(mysocket)
+    stream.start_handshake(handshake, handshake.build_request(get_resource()))
+    return stream
+
+
+async def open_async_stream(host, port, timeout):
+    """ Connect to a KiwiSDR and perform the websocket handshake with asyncio. Returns an AsyncStream """
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+
+    try:
+        handshake = wsclient.ClientHandshakeProcessor(None, host, port)
+        await asyncio.wait_for(handshake.handshake_async(reader, writer, get_resource()), timeout)
+    except Exception:
+        writer.close()
+        raise
+
+    stream_option = StreamOptions()
+    stream_option.mask_send = True
+    stream_option.unmask_receive = False
+
+    return AsyncStream(reader, writer, stream_option, mod_pywebsocket.common.VERSION_HYBI13)
+
+
+def get_setup_messages(password, zoom, offset, compression=False):
+    """ Login and waterfall setup commands, in the order they should be sent """
+    # max wf speed, no compression unless asked for
+    _msg_1 = 'SET auth t=kiwi p='
+    if password != 'NONE':
+        _msg_1 += password
+
+    return [_msg_1, 'SET zoom=%d start=%d'%(zoom,offset),\
+    'SET maxdb=0 mindb=-100', 'SET wf_speed=%d' % WF_SPEED_MAX, 'SET wf_comp=%d' % int(compression)]
+
+
+def start_waterfall(stream, password, zoom, offset, compression=False):
+    """ Send the login and waterfall setup commands to the server """
+    # send a sequence of messages to the server, hardcoded for now
+    for msg in get_setup_messages(password, zoom, offset, compression):
+        stream.send_message(msg)
+
+
+def set_waterfall_zoom(stream, zoom, offset):
+    """ Retune the waterfall on an open stream """
+    stream.send_message('SET zoom=%d start=%d'%(zoom,offset))
+
+
+def set_waterfall_speed(stream, speed):
+    """ Change the waterfall update rate. WF_SPEED_OFF pauses the waterfall. """
+    stream.send_message('SET wf_speed=%d' % speed)
+
+
+def send_keepalive(stream):
+    """ Keep an otherwise idle connection from being dropped by the server """
+    stream.send_message('SET keepalive')
+
+
+class WaterfallRing(object):
+    """ Preallocated ring of raw W/F messages, received into in place.
+
+    Each slot holds a whole W/F message (16 byte header followed by the bins), and
+    lines is a (size, bins) uint8 view of just the waterfall data in each slot.
+    """
+
+    def __init__(self, size, bins):
+        self.size = size
+        self.bins = bins
+        self._raw = np.zeros((size, WF_HEADER_LEN + bins), dtype=np.uint8)
+        self.lines = self._raw[:, WF_HEADER_LEN:]
+        # Create the slot views up front so nothing is allocated per message
+        self._slots = [memoryview(_row) for _row in self._raw]
+        self.index = 0
+
+    def next_slot(self):
+        """ Writable memoryview of the slot the next message should be received into """
+        return self._slots[self.index]
+
+    def commit(self):
+        """ Keep the message in the current slot, and return its line """
+        _line = self.lines[self.index]
+        self.index = (self.index + 1) % self.size
+        return _line
+
+
+def capture_waterfall(stream, length, accumulator, verbose=0, ring=None, compression=False, converged=None, archive=None, dispatcher=None, tracker=None):
+    """ Receive up to length waterfall lines into the accumulator. Returns the number of lines received
+
+    If accumulator is None the lines are discarded, and a ring must be given.
+    If converged is given, it is called with the accumulator every WF_CONVERGENCE_CHECK lines,
+    and the capture stops early once it returns True.
+    If archive (a WaterfallArchive) is given, every raw line is also appended to it.
+    Other messages are passed to dispatcher (a MessageDispatcher), if given.
+    If tracker (a SequenceTracker) is given, each line's sequence number is checked with it,
+    and lines it rejects are neither kept nor counted.
+    """
+    if ring is None:
+        ring = WaterfallRing(WF_RING_SIZE, accumulator.bins)
+    if compression:
+        _wf_length = WF_HEADER_LEN + (ring.bins + ADPCM_PAD + 1)//2
+    else:
+        _wf_length = WF_HEADER_LEN + ring.bins
+    # Messages that did not fit in a slot come back as bytes and are never waterfall lines
+    time = 0
+    while time<length:
+        # receive one msg from server, straight into the ring buffer
+        _slot = ring.next_slot()
+        try:
+            _received = stream.receive_message_into(_slot)
+        except:
+            print("Timeout waiting for data!")
+            break
+
+        if _received is None:
+            print("Server closed the connection!")
+            break
+
+        if isinstance(_received, int) and _received >= _wf_length and _slot[0:KIWI_TAG_LENGTH] == WF_TAG: # this is one waterfall line
+            _seq = get_waterfall_seq(_slot)
+            if tracker is not None and not tracker.check(_seq):
+                continue
+            if verbose:
+                print(time,)
+            if compression:
+                # Decode in place, the compressed data is read before the line is written
+                decode_waterfall_adpcm(_slot[WF_HEADER_LEN:_received], ring.bins, out=ring.lines[ring.index])
+            _line = ring.commit()
+            if archive is not None:
+                archive.write(_line, _seq)
+            if accumulator is not None:
+                accumulator.add(_line)
+            time += 1
+
+            if converged and time % WF_CONVERGENCE_CHECK == 0 and converged(accumulator):
+                break
+        elif dispatcher is not None:
+            # this is chatter between client and server
+            dispatcher.dispatch(_slot[:_received] if isinstance(_received, int) else _received)
+
+    return time
+
+
+def close_stream(sock, stream):
+    """ Close the websocket and the underlying socket """
+    try:
+        stream.close_connection(mod_pywebsocket.common.STATUS_GOING_AWAY)
+        sock.close()
+    except Exception as e:
+        print("exception: %s" % e)
@@ -25,7 +25,8 @@ FREQ_MAX = 30000
 def calculate_total_power(spectra):
     """ Calculate an estimate of the total power into the KiwiSDR """
 
-    _spectra_mw = 10**(spectra/10)
+    # Spectra from file aren't on the raw waterfall grid, so convert exactly (in float64, so dummy entries don't underflow to 0)
+    _spectra_mw = 10**(np.asarray(spectra, dtype=np.float64)/10)
     _timeseries = np.sum(_spectra_mw, axis=1)
 
     # Refer README.md for info on the -3 value.
@@ -35,10 +36,12 @@ def calculate_total_power(spectra):
 def main():
     # Read command-line arguments
     parser = argparse.ArgumentParser(description="KiwiSDR Spectrum Plotter", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('filename', type=str, help="KiwiSDR Spectrum Log File (CSV)")
+    parser.add_argument('filename', type=str, help="KiwiSDR Spectrum Log File (CSV or binary .spectra)")
     parser.add_argument("--hours", type=int, default=72, help="How many hours to plot.")
     parser.add_argument("--cmap_min", type=float, default=-110, help="Colormap Minimum Value (dBm)")
     parser.add_argument("--cmap_max", type=float, default=-30, help="Colormap Maximum Value (dBm)")
+    parser.add_argument("--start", type=str, default=None, help="Plot from this UTC time (e.g. 2026-03-01T00:00) instead of the last --hours.")
+    parser.add_argument("--end", type=str, default=None, help="Plot up to this UTC time (used with --start).")
     parser.add_argument("--clip", action="store_true", default=False, help="Clip file to the hour limit specified with --hours")
     parser.add_argument('--spectrograph', type=str, default=None, help="Save Spectrograph to this file.")
     parser.add_argument('--rxpower', type=str, default=None, help="Save RX Power Plot to this file.")
@@ -56,7 +59,12 @@ def main():
 
 
     # Read in file
-    _data = read_spectra_file(args.filename, time_limit = args.hours)
+    if args.start:
+        # Historical range, found using the spectra file's index
+        _end = parse_spectra_time(args.end) if args.end else None
+        _data = read_spectra_range(args.filename, parse_spectra_time(args.start), _end)
+    else:
+        _data = read_spectra_file(args.filename, time_limit = args.hours)
 
     if args.clip:
         clip_spectra_file(args.filename, time_limit=args.hours)
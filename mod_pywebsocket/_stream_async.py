@@ -0,0 +1,222 @@
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""This file provides an asyncio version of the RFC 6455 Stream, reading
+frames from an asyncio.StreamReader and writing them to an
+asyncio.StreamWriter. The framing, filters and control frame handling are
+those of _stream_hybi.Stream.
+"""
+
+
+import asyncio
+
+from mod_pywebsocket import common
+from mod_pywebsocket._stream_base import BadOperationException
+from mod_pywebsocket._stream_base import ConnectionTerminatedException
+from mod_pywebsocket._stream_hybi import Frame
+from mod_pywebsocket._stream_hybi import Stream
+from mod_pywebsocket._stream_hybi import _NO_MESSAGE
+from mod_pywebsocket._stream_hybi import parse_frame_header
+
+
+class _AsyncConnection(object):
+    """Provides the write side of the mp_conn interface over an
+    asyncio.StreamWriter. Written data is buffered by the writer, so the
+    synchronous Stream code can write without blocking.
+    """
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def write(self, data):
+        self._writer.write(data)
+
+    def get_remote_addr(self):
+        return self._writer.get_extra_info('peername')
+    remote_addr = property(get_remote_addr)
+
+
+class _AsyncRequest(object):
+    """Minimal stand-in for the mp_request object Stream expects."""
+
+    def __init__(self, writer, ws_version):
+        self.connection = _AsyncConnection(writer)
+        self.ws_version = ws_version
+
+
+class AsyncStream(Stream):
+    """A Stream for use with asyncio. receive_message, send_message and
+    close_connection are coroutines; everything else behaves as in Stream.
+    """
+
+    def __init__(self, reader, writer, options,
+                 ws_version=common.VERSION_HYBI_LATEST):
+        """Constructs an instance.
+
+        Args:
+            reader: asyncio.StreamReader positioned after the opening
+                handshake.
+            writer: asyncio.StreamWriter for the same connection.
+            options: StreamOptions.
+            ws_version: the version of WebSocket protocol.
+        """
+
+        Stream.__init__(self, _AsyncRequest(writer, ws_version), options)
+
+        self._reader = reader
+        self._stream_writer = writer
+
+    async def _read_exactly(self, length):
+        """Reads exactly length bytes.
+
+        Raises:
+            ConnectionTerminatedException: when the connection is closed
+                first.
+        """
+
+        try:
+            return await self._reader.readexactly(length)
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionTerminatedException(
+                'Receiving %d byte failed. Peer (%r) closed connection' %
+                (length, (self._request.connection.remote_addr,)))
+        except (ConnectionError, OSError) as e:
+            raise ConnectionTerminatedException(
+                'Receiving %d byte failed. socket.error (%s) occurred' %
+                (length, e))
+
+    async def _receive_frame_header_async(self):
+        """Receives a frame header, leaving the payload unread. The whole
+        header is read first, then decoded by parse_frame_header.
+        """
+
+        header = await self._read_exactly(2)
+        extra_length = 0
+        if header[1] & 0x7f == 126:
+            extra_length = 2
+        elif header[1] & 0x7f == 127:
+            extra_length = 8
+        if header[1] & 0x80:
+            extra_length += 4
+        if extra_length:
+            header += await self._read_exactly(extra_length)
+
+        offset = [0]
+
+        def _receive_bytes(length):
+            data = header[offset[0]:offset[0] + length]
+            offset[0] += length
+            return data
+
+        return parse_frame_header(
+            receive_bytes=_receive_bytes,
+            logger=self._logger,
+            ws_version=self._request.ws_version,
+            unmask_receive=self._options.unmask_receive)
+
+    async def receive_message(self):
+        """Receive a WebSocket message. Control frames are processed (pings
+        answered, close acknowledged) as in Stream.receive_message.
+
+        Returns:
+            payload data of the message, or None iff received closing
+            handshake.
+        Raises:
+            see Stream.receive_message.
+        """
+
+        if self._request.client_terminated:
+            raise BadOperationException(
+                'Requested receive_message after receiving a closing '
+                'handshake')
+
+        while True:
+            opcode, fin, rsv1, rsv2, rsv3, payload_length, masker = (
+                await self._receive_frame_header_async())
+            payload = masker.mask(await self._read_exactly(payload_length))
+
+            frame = Frame(fin=fin, rsv1=rsv1, rsv2=rsv2, rsv3=rsv3,
+                          opcode=opcode, payload=payload)
+            message = self._process_frame(frame)
+            # Let any pong or close acknowledgement go out.
+            await self.drain()
+            if message is not _NO_MESSAGE:
+                return message
+
+    async def send_message(self, message, end=True, binary=False):
+        """Send message, waiting for the writer to drain if its buffer is
+        full. See Stream.send_message.
+        """
+
+        Stream.send_message(self, message, end, binary)
+        await self.drain()
+
+    async def drain(self):
+        """Waits until the buffered outgoing data has been handed to the
+        transport, if too much of it is queued up.
+        """
+
+        try:
+            await self._stream_writer.drain()
+        except (ConnectionError, OSError) as e:
+            raise ConnectionTerminatedException(
+                'Sending failed. socket.error (%s) occurred' % e)
+
+    def abort_connection(self):
+        """Closes the connection without a closing handshake."""
+
+        self._stream_writer.close()
+
+    async def close_connection(self, code=common.STATUS_NORMAL_CLOSURE,
+                               reason='', wait_response=True):
+        """Closes a WebSocket connection, waiting for the acknowledgement of
+        the closing handshake if wait_response is set, then closes the
+        writer. See Stream.close_connection.
+        """
+
+        try:
+            if not self._request.server_terminated:
+                Stream.close_connection(self, code, reason,
+                                        wait_response=False)
+                await self.drain()
+
+                if (wait_response and
+                    code != common.STATUS_GOING_AWAY and
+                    code != common.STATUS_PROTOCOL_ERROR and
+                    not self._request.client_terminated):
+                    message = await self.receive_message()
+                    if message is not None:
+                        raise ConnectionTerminatedException(
+                            'Didn\'t receive valid ack for closing handshake')
+        finally:
+            self._stream_writer.close()
+
+
+# vi:sts=4 sw=4 et
@@ -44,6 +44,11 @@ import socket
 from mod_pywebsocket import util
 
 
+# Size of the read-ahead buffer. A single read from the connection fills as
+# much of it as is available, so several small frames can be parsed per read.
+_READ_BUFFER_SIZE = 65536
+
+
 # Exceptions
 
 
@@ -103,14 +108,57 @@ class StreamBase(object):
 
         self._request = request
 
+        # Read-ahead is only possible when the connection can read into a
+        # buffer (see _read_into). Otherwise every read goes to the connection.
+        connection = getattr(request, 'connection', None)
+        self._read_ahead = hasattr(connection, 'read_into')
+        if self._read_ahead:
+            self._read_buffer = bytearray(_READ_BUFFER_SIZE)
+            self._read_buffer_view = memoryview(self._read_buffer)
+        self._read_start = 0
+        self._read_end = 0
+
+    def get_buffered_length(self):
+        """Returns the number of bytes already read from the connection but
+        not yet consumed. Callers waiting on the socket (e.g. with select)
+        should check this first, as these bytes will not wake them up.
+        """
+
+        return self._read_end - self._read_start
+
+    def _fill_read_buffer(self):
+        """Refills the (empty) read-ahead buffer with one read from the
+        connection.
+        """
+
+        self._read_start = 0
+        self._read_end = 0
+        self._read_end = self._read_into(self._read_buffer_view)
+
+    def _take_buffered(self, length):
+        """Returns up to length bytes from the read-ahead buffer."""
+
+        end = min(self._read_start + length, self._read_end)
+        read_bytes = self._read_buffer[self._read_start:end]
+        self._read_start = end
+        return read_bytes
+
     def _read(self, length):
-        """Reads length bytes from connection. In case we catch any exception,
+        """Reads up to length bytes from connection, going through the
+        read-ahead buffer where possible. In case we catch any exception,
         prepends remote address to the exception message and raise again.
 
         Raises:
             ConnectionTerminatedException: when read returns empty string.
         """
 
+        if self._read_ahead:
+            if (self._read_start == self._read_end and
+                length < _READ_BUFFER_SIZE):
+                self._fill_read_buffer()
+            if self._read_start < self._read_end:
+                return self._take_buffered(length)
+
         try:
             read_bytes = self._request.connection.read(length)
             if not read_bytes:
@@ -132,6 +180,31 @@ class StreamBase(object):
                 'Receiving %d byte failed. IOError (%s) occurred' %
                 (length, e))
 
+    def _read_into(self, buffer):
+        """Reads up to len(buffer) bytes from connection straight into buffer
+        and returns the number of bytes read. The connection must provide a
+        read_into method. Exceptions are handled as in _read.
+
+        Raises:
+            ConnectionTerminatedException: when read returns no bytes.
+        """
+
+        try:
+            read_length = self._request.connection.read_into(buffer)
+            if not read_length:
+                raise ConnectionTerminatedException(
+                    'Receiving %d byte failed. Peer (%r) closed connection' %
+                    (len(buffer), (self._request.connection.remote_addr,)))
+            return read_length
+        except socket.error as e:
+            raise ConnectionTerminatedException(
+                'Receiving %d byte failed. socket.error (%s) occurred' %
+                (len(buffer), e))
+        except IOError as e:
+            raise ConnectionTerminatedException(
+                'Receiving %d byte failed. IOError (%s) occurred' %
+                (len(buffer), e))
+
     def _write(self, bytes_to_write):
         """Writes given bytes to connection. In case we catch any exception,
         prepends remote address to the exception message and raise again.
@@ -154,6 +227,10 @@ class StreamBase(object):
             ConnectionTerminatedException: when read returns empty string.
         """
 
+        # Fast path: the whole request is already in the read-ahead buffer.
+        if self._read_end - self._read_start >= length:
+            return self._take_buffered(length)
+
         read_bytes = []
         while length > 0:
             new_read_bytes = self._read(length)
@@ -164,6 +241,30 @@ class StreamBase(object):
         else:
             return bytearray().join(read_bytes)
 
+    def receive_bytes_into(self, buffer):
+        """Fills buffer (a writable memoryview) from the connection without
+        intermediate copies. Retries read when we couldn't receive the
+        specified amount.
+
+        Raises:
+            ConnectionTerminatedException: when read returns empty string.
+        """
+
+        offset = 0
+        length = len(buffer)
+        while offset < length:
+            if self._read_start == self._read_end:
+                if length - offset >= _READ_BUFFER_SIZE:
+                    # Too big to be worth buffering, read it in directly.
+                    offset += self._read_into(buffer[offset:])
+                    continue
+                self._fill_read_buffer()
+            count = min(length - offset, self._read_end - self._read_start)
+            buffer[offset:offset + count] = self._read_buffer_view[
+                self._read_start:self._read_start + count]
+            self._read_start += count
+            offset += count
+
     def _read_until(self, delim_char):
         """Reads bytes until we encounter delim_char. The result will not
         contain delim_char.
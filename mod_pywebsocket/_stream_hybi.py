@@ -42,10 +42,6 @@ import os
 import struct
 import time
 
-import sys
-if sys.version_info > (3,):
-    buffer = memoryview
-
 from mod_pywebsocket import common
 from mod_pywebsocket import util
 from mod_pywebsocket._stream_base import BadOperationException
@@ -58,6 +54,16 @@ from mod_pywebsocket._stream_base import UnsupportedFrameException
 
 _NOOP_MASKER = util.NoopMasker()
 
+# Precompiled frame header layouts: the first 2 octets, the first 2 octets
+# followed by a 2-octet extended payload length, and the extended lengths.
+_FRAME_HEADER = struct.Struct('!BB')
+_FRAME_HEADER_EXTENDED_16 = struct.Struct('!BBH')
+_EXTENDED_LENGTH_16 = struct.Struct('!H')
+_EXTENDED_LENGTH_64 = struct.Struct('!Q')
+
+# Returned by Stream._process_frame when no message is complete yet.
+_NO_MESSAGE = object()
+
 
 class Frame(object):
 
@@ -166,21 +172,14 @@ def create_text_frame(
                                frame_filters)
 
 
-def parse_frame(receive_bytes, logger=None,
-                ws_version=common.VERSION_HYBI_LATEST,
-                unmask_receive=True):
-    """Parses a frame. Returns a tuple containing each header field and
-    payload.
+def parse_frame_header(receive_bytes, logger=None,
+                       ws_version=common.VERSION_HYBI_LATEST,
+                       unmask_receive=True):
+    """Parses a frame header, leaving the payload unread. Returns a tuple
+    containing each header field, the payload length and a masker to apply
+    to the payload.
 
-    Args:
-        receive_bytes: a function that reads frame data from a stream or
-            something similar. The function takes length of the bytes to be
-            read. The function must raise ConnectionTerminatedException if
-            there is not enough data to be read.
-        logger: a logging object.
-        ws_version: the version of WebSocket protocol.
-        unmask_receive: unmask received frames. When received unmasked
-            frame, raises InvalidFrameException.
+    Args: see parse_frame.
 
     Raises:
         ConnectionTerminatedException: when receive_bytes raises it.
@@ -189,29 +188,29 @@ def parse_frame(receive_bytes, logger=None,
     if not logger:
         logger = logging.getLogger()
 
-    logger.log(common.LOGLEVEL_FINE, 'Receive the first 2 octets of a frame')
+    # Skip formatting the per-frame debug messages unless they are wanted.
+    log_fine = logger.isEnabledFor(common.LOGLEVEL_FINE)
 
-    received = receive_bytes(2)
-    if type(received[0]) is int:
-        received = [x for x in received]
-    else:
-        received = map(ord, received);
+    if log_fine:
+        logger.log(common.LOGLEVEL_FINE,
+                   'Receive the first 2 octets of a frame')
+
+    first_byte, second_byte = _FRAME_HEADER.unpack(receive_bytes(2))
 
-    first_byte = (received[0])
     fin = (first_byte >> 7) & 1
     rsv1 = (first_byte >> 6) & 1
     rsv2 = (first_byte >> 5) & 1
     rsv3 = (first_byte >> 4) & 1
     opcode = first_byte & 0xf
 
-    second_byte = (received[1])
     mask = (second_byte >> 7) & 1
     payload_length = second_byte & 0x7f
 
-    logger.log(common.LOGLEVEL_FINE,
-               'FIN=%s, RSV1=%s, RSV2=%s, RSV3=%s, opcode=%s, '
-               'Mask=%s, Payload_length=%s',
-               fin, rsv1, rsv2, rsv3, opcode, mask, payload_length)
+    if log_fine:
+        logger.log(common.LOGLEVEL_FINE,
+                   'FIN=%s, RSV1=%s, RSV2=%s, RSV3=%s, opcode=%s, '
+                   'Mask=%s, Payload_length=%s',
+                   fin, rsv1, rsv2, rsv3, opcode, mask, payload_length)
 
     if (mask == 1) != unmask_receive:
         raise InvalidFrameException(
@@ -224,12 +223,11 @@ def parse_frame(receive_bytes, logger=None,
     valid_length_encoding = True
     length_encoding_bytes = 1
     if payload_length == 127:
-        logger.log(common.LOGLEVEL_FINE,
-                   'Receive 8-octet extended payload length')
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Receive 8-octet extended payload length')
 
-        extended_payload_length = receive_bytes(8)
-        payload_length = struct.unpack(
-            '!Q', buffer(extended_payload_length))[0]
+        payload_length = _EXTENDED_LENGTH_64.unpack(receive_bytes(8))[0]
         if payload_length > 0x7FFFFFFFFFFFFFFF:
             raise InvalidFrameException(
                 'Extended payload length >= 2^63')
@@ -237,21 +235,22 @@ def parse_frame(receive_bytes, logger=None,
             valid_length_encoding = False
             length_encoding_bytes = 8
 
-        logger.log(common.LOGLEVEL_FINE,
-                   'Decoded_payload_length=%s', payload_length)
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Decoded_payload_length=%s', payload_length)
     elif payload_length == 126:
-        logger.log(common.LOGLEVEL_FINE,
-                   'Receive 2-octet extended payload length')
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Receive 2-octet extended payload length')
 
-        extended_payload_length = receive_bytes(2)
-        payload_length = struct.unpack(
-            '!H', buffer(extended_payload_length))[0]
+        payload_length = _EXTENDED_LENGTH_16.unpack(receive_bytes(2))[0]
         if ws_version >= 13 and payload_length < 126:
             valid_length_encoding = False
             length_encoding_bytes = 2
 
-        logger.log(common.LOGLEVEL_FINE,
-                   'Decoded_payload_length=%s', payload_length)
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE,
+                       'Decoded_payload_length=%s', payload_length)
 
     if not valid_length_encoding:
         logger.warning(
@@ -261,34 +260,65 @@ def parse_frame(receive_bytes, logger=None,
             length_encoding_bytes)
 
     if mask == 1:
-        logger.log(common.LOGLEVEL_FINE, 'Receive mask')
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE, 'Receive mask')
 
         masking_nonce = receive_bytes(4)
         masker = util.RepeatedXorMasker(masking_nonce)
 
-        logger.log(common.LOGLEVEL_FINE, 'Mask=%r', masking_nonce)
+        if log_fine:
+            logger.log(common.LOGLEVEL_FINE, 'Mask=%r', masking_nonce)
     else:
         masker = _NOOP_MASKER
 
-    logger.log(common.LOGLEVEL_FINE, 'Receive payload data')
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+    return opcode, fin, rsv1, rsv2, rsv3, payload_length, masker
+
+
+def parse_frame(receive_bytes, logger=None,
+                ws_version=common.VERSION_HYBI_LATEST,
+                unmask_receive=True):
+    """Parses a frame. Returns a tuple containing each header field and
+    payload.
+
+    Args:
+        receive_bytes: a function that reads frame data from a stream or
+            something similar. The function takes length of the bytes to be
+            read. The function must raise ConnectionTerminatedException if
+            there is not enough data to be read.
+        logger: a logging object.
+        ws_version: the version of WebSocket protocol.
+        unmask_receive: unmask received frames. When received unmasked
+            frame, raises InvalidFrameException.
+
+    Raises:
+        ConnectionTerminatedException: when receive_bytes raises it.
+        InvalidFrameException: when the frame contains invalid data.
+    """
+    if not logger:
+        logger = logging.getLogger()
+
+    opcode, fin, rsv1, rsv2, rsv3, payload_length, masker = (
+        parse_frame_header(receive_bytes, logger, ws_version, unmask_receive))
+
+    log_fine = logger.isEnabledFor(common.LOGLEVEL_FINE)
+
+    if log_fine:
+        logger.log(common.LOGLEVEL_FINE, 'Receive payload data')
         receive_start = time.time()
 
     raw_payload_bytes = receive_bytes(payload_length)
 
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+    if log_fine:
         logger.log(
             common.LOGLEVEL_FINE,
             'Done receiving payload data at %s MB/s',
             payload_length / (time.time() - receive_start) / 1000 / 1000)
-    logger.log(common.LOGLEVEL_FINE, 'Unmask payload data')
-
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+        logger.log(common.LOGLEVEL_FINE, 'Unmask payload data')
         unmask_start = time.time()
 
     unmasked_bytes = masker.mask(raw_payload_bytes)
 
-    if logger.isEnabledFor(common.LOGLEVEL_FINE):
+    if log_fine:
         logger.log(
             common.LOGLEVEL_FINE,
             'Done unmasking payload data at %s MB/s',
@@ -450,13 +480,50 @@ class Stream(StreamBase):
             InvalidFrameException: when the frame contains invalid data.
         """
 
-        def _receive_bytes(length):
-            return self.receive_bytes(length)
+        opcode, fin, rsv1, rsv2, rsv3, payload_length, masker = (
+            self._receive_frame_header())
+
+        unmasked_bytes = masker.mask(self.receive_bytes(payload_length))
+
+        return opcode, unmasked_bytes, fin, rsv1, rsv2, rsv3
+
+    def _receive_frame_header(self):
+        """Receives a frame header, leaving the payload unread.
+
+        Raises:
+            ConnectionTerminatedException: when read returns empty
+                string.
+            InvalidFrameException: when the frame contains invalid data.
+        """
+
+        # Fast path for the common case of an unmasked frame whose header is
+        # already in the read-ahead buffer, with a 7-bit or minimally encoded
+        # 2-octet payload length: decode it with one unpack and no copies.
+        if (not self._options.unmask_receive and
+            self._read_end - self._read_start >= _FRAME_HEADER_EXTENDED_16.size and
+            not self._logger.isEnabledFor(common.LOGLEVEL_FINE)):
+            first_byte, second_byte, extended_length = (
+                _FRAME_HEADER_EXTENDED_16.unpack_from(
+                    self._read_buffer, self._read_start))
+            if second_byte < 126:
+                self._read_start += _FRAME_HEADER.size
+                payload_length = second_byte
+            elif second_byte == 126 and extended_length >= 126:
+                self._read_start += _FRAME_HEADER_EXTENDED_16.size
+                payload_length = extended_length
+            else:
+                payload_length = None
+
+            if payload_length is not None:
+                return (first_byte & 0xf, (first_byte >> 7) & 1,
+                        (first_byte >> 6) & 1, (first_byte >> 5) & 1,
+                        (first_byte >> 4) & 1, payload_length, _NOOP_MASKER)
 
-        return parse_frame(receive_bytes=_receive_bytes,
-                           logger=self._logger,
-                           ws_version=self._request.ws_version,
-                           unmask_receive=self._options.unmask_receive)
+        return parse_frame_header(
+            receive_bytes=self.receive_bytes,
+            logger=self._logger,
+            ws_version=self._request.ws_version,
+            unmask_receive=self._options.unmask_receive)
 
     def _receive_frame_as_frame_object(self):
         opcode, unmasked_bytes, fin, rsv1, rsv2, rsv3 = self._receive_frame()
@@ -634,7 +701,7 @@ class Stream(StreamBase):
                 'status code must be 2 octet')
         elif len(message) >= 2:
             self._request.ws_close_code = struct.unpack(
-                '!H', buffer(message[0:2]))[0]
+                '!H', message[0:2])[0]
             self._request.ws_close_reason = message[2:].decode(
                 'utf-8', 'replace')
             self._logger.debug(
@@ -755,51 +822,108 @@ class Stream(StreamBase):
             # Timeout is controlled by TimeOut directive of Apache.
 
             frame = self._receive_frame_as_frame_object()
+            message = self._process_frame(frame)
+            if message is not _NO_MESSAGE:
+                return message
+
+    def _process_frame(self, frame):
+        """Applies filters to a received frame and processes it. Returns the
+        message for receive_message to return, or _NO_MESSAGE if more frames
+        need to be received first.
+        """
 
-            # Check the constraint on the payload size for control frames
-            # before extension processes the frame.
-            # See also http://tools.ietf.org/html/rfc6455#section-5.5
-            if (common.is_control_opcode(frame.opcode) and
-                len(frame.payload) > 125):
-                raise InvalidFrameException(
-                    'Payload data size of control frames must be 125 bytes or '
-                    'less')
-
-            for frame_filter in self._options.incoming_frame_filters:
-                frame_filter.filter(frame)
-
-            if frame.rsv1 or frame.rsv2 or frame.rsv3:
-                raise UnsupportedFrameException(
-                    'Unsupported flag is set (rsv = %d%d%d)' %
-                    (frame.rsv1, frame.rsv2, frame.rsv3))
-
-            message = self._get_message_from_frame(frame)
-            if message is None:
-                continue
-
-            for message_filter in self._options.incoming_message_filters:
-                message = message_filter.filter(message)
-
-            if self._original_opcode == common.OPCODE_TEXT:
-                # The WebSocket protocol section 4.4 specifies that invalid
-                # characters must be replaced with U+fffd REPLACEMENT
-                # CHARACTER.
-                try:
-                    return message.decode('utf-8')
-                except UnicodeDecodeError as e:
-                    raise InvalidUTF8Exception(e)
-            elif self._original_opcode == common.OPCODE_BINARY:
+        # Check the constraint on the payload size for control frames
+        # before extension processes the frame.
+        # See also http://tools.ietf.org/html/rfc6455#section-5.5
+        if (common.is_control_opcode(frame.opcode) and
+            len(frame.payload) > 125):
+            raise InvalidFrameException(
+                'Payload data size of control frames must be 125 bytes or '
+                'less')
+
+        for frame_filter in self._options.incoming_frame_filters:
+            frame_filter.filter(frame)
+
+        if frame.rsv1 or frame.rsv2 or frame.rsv3:
+            raise UnsupportedFrameException(
+                'Unsupported flag is set (rsv = %d%d%d)' %
+                (frame.rsv1, frame.rsv2, frame.rsv3))
+
+        message = self._get_message_from_frame(frame)
+        if message is None:
+            return _NO_MESSAGE
+
+        for message_filter in self._options.incoming_message_filters:
+            message = message_filter.filter(message)
+
+        if self._original_opcode == common.OPCODE_TEXT:
+            # The WebSocket protocol section 4.4 specifies that invalid
+            # characters must be replaced with U+fffd REPLACEMENT
+            # CHARACTER.
+            try:
+                return message.decode('utf-8')
+            except UnicodeDecodeError as e:
+                raise InvalidUTF8Exception(e)
+        elif self._original_opcode == common.OPCODE_BINARY:
+            return message
+        elif self._original_opcode == common.OPCODE_CLOSE:
+            self._process_close_message(message)
+            return None
+        elif self._original_opcode == common.OPCODE_PING:
+            self._process_ping_message(message)
+        elif self._original_opcode == common.OPCODE_PONG:
+            self._process_pong_message(message)
+        else:
+            raise UnsupportedFrameException(
+                'Opcode %d is not supported' % self._original_opcode)
+        return _NO_MESSAGE
+
+    def receive_message_into(self, buffer):
+        """Receive a WebSocket message, writing its payload straight into
+        buffer (a writable bytes-like object such as a memoryview) when it
+        can. Control frames are processed as in receive_message.
+
+        Only unfragmented, unmasked binary frames that fit in buffer are
+        received in place, and only when no incoming filters are configured.
+        Any other message is received as by receive_message and returned as
+        is, leaving buffer untouched.
+
+        Returns:
+            the number of payload bytes written to buffer, or the message
+            itself if it could not be received in place, or None iff
+            received closing handshake.
+        Raises:
+            see receive_message.
+        """
+
+        if self._request.client_terminated:
+            raise BadOperationException(
+                'Requested receive_message_into after receiving a closing '
+                'handshake')
+
+        if (self._options.incoming_frame_filters or
+            self._options.incoming_message_filters):
+            return self.receive_message()
+
+        while True:
+            opcode, fin, rsv1, rsv2, rsv3, payload_length, masker = (
+                self._receive_frame_header())
+
+            if (opcode == common.OPCODE_BINARY and fin and
+                not (rsv1 or rsv2 or rsv3) and
+                not self._received_fragments and
+                masker is _NOOP_MASKER and payload_length <= len(buffer)):
+                self._original_opcode = opcode
+                self.receive_bytes_into(memoryview(buffer)[:payload_length])
+                return payload_length
+
+            # Anything else takes the regular path.
+            payload = masker.mask(self.receive_bytes(payload_length))
+            frame = Frame(fin=fin, rsv1=rsv1, rsv2=rsv2, rsv3=rsv3,
+                          opcode=opcode, payload=payload)
+            message = self._process_frame(frame)
+            if message is not _NO_MESSAGE:
                 return message
-            elif self._original_opcode == common.OPCODE_CLOSE:
-                self._process_close_message(message)
-                return None
-            elif self._original_opcode == common.OPCODE_PING:
-                self._process_ping_message(message)
-            elif self._original_opcode == common.OPCODE_PONG:
-                self._process_pong_message(message)
-            else:
-                raise UnsupportedFrameException(
-                    'Opcode %d is not supported' % self._original_opcode)
 
     def _send_closing_handshake(self, code, reason):
         body = create_closing_handshake_body(code, reason)
@@ -36,6 +36,7 @@ from mod_pywebsocket._stream_base import ConnectionTerminatedException
 from mod_pywebsocket._stream_base import InvalidFrameException
 from mod_pywebsocket._stream_base import InvalidUTF8Exception
 from mod_pywebsocket._stream_base import UnsupportedFrameException
+from mod_pywebsocket._stream_async import AsyncStream
 from mod_pywebsocket._stream_hixie75 import StreamHixie75
 from mod_pywebsocket._stream_hybi import Frame
 from mod_pywebsocket._stream_hybi import Stream
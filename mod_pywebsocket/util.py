@@ -217,10 +217,35 @@ class RepeatedXorMasker(object):
 
         return result.tobytes()
 
+    def _mask_using_int(self, s):
+        """Perform the mask via python, XORing the whole string at once.
+
+        The masking key is rotated to start at the current index, repeated
+        to the length of the string and XORed with it as one big integer.
+        """
+        length = len(s)
+        if length == 0:
+            return b''
+
+        masking_key = bytes(self._masking_key)
+        masking_key_size = len(masking_key)
+        masking_key_index = self._masking_key_index
+
+        rotated_key = (masking_key[masking_key_index:] +
+                       masking_key[:masking_key_index])
+        repeated_key = (rotated_key * (length // masking_key_size + 1))[:length]
+        masked = (int.from_bytes(s, 'big') ^
+                  int.from_bytes(repeated_key, 'big'))
+
+        self._masking_key_index = (
+                (masking_key_index + length) % masking_key_size)
+
+        return masked.to_bytes(length, 'big')
+
     if 'fast_masking' in globals():
         mask = _mask_using_swig
     else:
-        mask = _mask_using_array
+        mask = _mask_using_int
 
 
 # By making wbits option negative, we can suppress CMF/FLG (2 octet) and
@@ -0,0 +1,316 @@
+#
+#   Helper classes to service many websocket connections from one thread with selectors.
+#
+#   Each socket is non-blocking, from the connect and websocket handshake on, and its bytes
+#   are fed into a FrameParser as they arrive, so a slow or stalled server never holds up
+#   the others.
+#
+import logging
+import os
+import selectors
+import socket
+
+import mod_pywebsocket.common
+from mod_pywebsocket._stream_hybi import FragmentedFrameBuilder
+from mod_pywebsocket._stream_hybi import create_close_frame
+from mod_pywebsocket._stream_hybi import create_pong_frame
+from mod_pywebsocket._stream_hybi import parse_frame_header
+
+# Bytes read from a ready socket at a time
+POLL_READ_SIZE = 65536
+
+# Give up on a handshake response header longer than this
+POLL_MAX_RESPONSE_SIZE = 65536
+
+
+class FrameParser(object):
+    """ Websocket frame parser that is fed bytes as they arrive, and hands back only complete frames """
+
+    def __init__(self, unmask_receive=False):
+        self._buffer = bytearray()
+        self._unmask_receive = unmask_receive
+
+    def feed(self, data):
+        self._buffer += data
+
+    def frames(self):
+        """ Decode and remove all the complete frames in the buffer. Returns a list of (opcode, fin, payload) """
+        _frames = []
+        _offset = 0
+        _available = len(self._buffer)
+
+        while _available - _offset >= 2:
+            # Work out the header length before decoding it, as it may not all be here yet
+            _length = self._buffer[_offset + 1] & 0x7f
+            _header_length = 2
+            if _length == 126:
+                _header_length += 2
+            elif _length == 127:
+                _header_length += 8
+            if self._buffer[_offset + 1] & 0x80:
+                _header_length += 4
+            if _available - _offset < _header_length:
+                break
+
+            _position = [_offset]
+
+            def _receive_bytes(length):
+                _data = self._buffer[_position[0]:_position[0] + length]
+                _position[0] += length
+                return _data
+
+            opcode, fin, rsv1, rsv2, rsv3, payload_length, masker = parse_frame_header(
+                _receive_bytes, unmask_receive=self._unmask_receive)
+
+            _start = _offset + _header_length
+            if _available - _start < payload_length:
+                break
+
+            _frames.append((opcode, fin, masker.mask(bytes(self._buffer[_start:_start + payload_length]))))
+            _offset = _start + payload_length
+
+        if _offset:
+            del self._buffer[:_offset]
+        return _frames
+
+
+class PolledStream(object):
+    """ A websocket on a non-blocking socket, read by a Poller.
+
+    Control frames are answered here; text and binary messages are handed on.
+    Outgoing data the socket can't take straight away is queued, and sent by the
+    Poller once the socket is writable. See start_handshake() for a stream whose
+    socket is still connecting.
+    """
+
+    def __init__(self, sock, pending=b'', mask_send=True):
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.closed = False
+        self._outgoing = bytearray()
+
+        # Connect and handshake state, see start_handshake()
+        self.handshaking = False
+        self._connecting = False
+        self._handshake = None
+        self._response = bytearray()
+        self._held = bytearray()
+
+        self._mask_send = mask_send
+        self._builder = FragmentedFrameBuilder(mask_send)
+        self._parser = FrameParser()
+        # Frames that arrived along with the handshake response
+        self._parser.feed(pending)
+
+        self._fragments = []
+        self._fragment_opcode = None
+
+    def start_handshake(self, handshake, request):
+        """ Queue the opening handshake request on a socket that may still be connecting.
+
+        handshake checks the response once it has all arrived (a wsclient.ClientHandshakeProcessor).
+        Messages sent before then are held back, as the server won't read frames until it has answered.
+        """
+        self.handshaking = True
+        self._connecting = True
+        self._handshake = handshake
+        self._outgoing += request
+
+    def send_message(self, message, binary=False):
+        self._write(self._builder.build(message, True, binary))
+
+    def _write(self, data):
+        if self.closed:
+            return
+        if self.handshaking:
+            self._held += data
+            return
+        self._outgoing += data
+        self.flush()
+
+    def wants_write(self):
+        """ True if there is queued data waiting for the socket to become writable """
+        return len(self._outgoing) > 0 and not self.closed
+
+    def flush(self):
+        """ Send as much of the queued data as the socket will take without blocking """
+        if self.closed:
+            return
+        if self._connecting:
+            # Only called once the socket is writable, which means the connect has finished one way or the other
+            _error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if _error:
+                logging.error('PolledStream connect error: "%s"' % os.strerror(_error))
+                self.closed = True
+                self._outgoing.clear()
+                return
+            self._connecting = False
+        if not self._outgoing:
+            return
+        try:
+            _sent = self.socket.send(self._outgoing)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logging.error('PolledStream write error: "%s"' % e)
+            self.closed = True
+            self._outgoing.clear()
+            return
+        del self._outgoing[:_sent]
+
+    def read_messages(self, buffer):
+        """ Read what is waiting on the socket, using buffer (a writable memoryview) as scratch space.
+
+        Returns the complete messages received, with None at the end if the connection has closed.
+        """
+        try:
+            _received = self.socket.recv_into(buffer)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            self.closed = True
+            return [None]
+
+        if _received == 0:
+            self.closed = True
+            return [None]
+
+        if self.handshaking:
+            return self._read_handshake(buffer[:_received])
+
+        self._parser.feed(buffer[:_received])
+        return self.pending_messages()
+
+    def _read_handshake(self, data):
+        """ Collect the handshake response, and check it once it's complete """
+        # The terminator may straddle two reads, so look back a little
+        _search = max(0, len(self._response) - 3)
+        self._response += data
+        _end = self._response.find(b'\r\n\r\n', _search)
+        if _end < 0:
+            if len(self._response) > POLL_MAX_RESPONSE_SIZE:
+                logging.error('PolledStream handshake error: "Response header longer than %d bytes"' % POLL_MAX_RESPONSE_SIZE)
+                self.closed = True
+                return [None]
+            return []
+
+        _end += 4
+        try:
+            self._handshake.process_response(bytes(self._response[:_end]))
+        except Exception as e:
+            logging.error('PolledStream handshake error: "%s"' % e)
+            self.closed = True
+            return [None]
+
+        # Frames that arrived along with the response
+        self._parser.feed(self._response[_end:])
+        self._response.clear()
+        self._handshake = None
+        self.handshaking = False
+
+        self._write(bytes(self._held))
+        self._held.clear()
+        return self.pending_messages()
+
+    def pending_messages(self):
+        """ Messages already complete in the parser, e.g. those that came with the handshake """
+        try:
+            _frames = self._parser.frames()
+        except Exception as e:
+            # Nothing after a bad frame can be trusted, so drop the connection
+            logging.error('PolledStream frame error: "%s"' % e)
+            self.closed = True
+            return [None]
+
+        _messages = []
+        for opcode, fin, payload in _frames:
+            if opcode == mod_pywebsocket.common.OPCODE_PING:
+                self._write(create_pong_frame(payload, mask=self._mask_send))
+            elif opcode == mod_pywebsocket.common.OPCODE_PONG:
+                pass
+            elif opcode == mod_pywebsocket.common.OPCODE_CLOSE:
+                # Acknowledge the close, nothing more will follow it
+                self._write(create_close_frame(payload[:2], mask=self._mask_send))
+                self.closed = True
+                _messages.append(None)
+                break
+            else:
+                if opcode != mod_pywebsocket.common.OPCODE_CONTINUATION:
+                    self._fragment_opcode = opcode
+                self._fragments.append(payload)
+                if not fin:
+                    continue
+
+                _message = b''.join(self._fragments)
+                self._fragments = []
+                if self._fragment_opcode == mod_pywebsocket.common.OPCODE_TEXT:
+                    _message = _message.decode('utf-8', 'replace')
+                _messages.append(_message)
+        return _messages
+
+    def close(self):
+        self.closed = True
+        self._outgoing.clear()
+        self._held.clear()
+        self.socket.close()
+
+
+class Poller(object):
+    """ Waits on many PolledStreams at once, and passes each message received to its stream's callback.
+
+    A stream that fails, whether on a read, a write or a bad frame, gets None passed to its
+    callback and is dropped, without affecting the others.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        # One read buffer shared by all the streams, they are only read one at a time
+        self._buffer = memoryview(bytearray(POLL_READ_SIZE))
+
+    def register(self, stream, callback):
+        """ Start watching a stream. callback is called with each message, and None when the connection closes """
+        self._selector.register(stream.socket, selectors.EVENT_READ, (stream, callback))
+        for _message in stream.pending_messages():
+            callback(_message)
+
+    def unregister(self, stream):
+        try:
+            self._selector.unregister(stream.socket)
+        except (KeyError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        """ Wait up to timeout seconds for data, and dispatch any messages that arrive """
+        for _key in list(self._selector.get_map().values()):
+            _stream, _callback = _key.data
+            if _stream.closed:
+                # Failed on a write since the last poll
+                self.unregister(_stream)
+                _callback(None)
+                continue
+
+            # Only ask about writability while there is something waiting to go out
+            _events = selectors.EVENT_READ
+            if _stream.wants_write():
+                _events |= selectors.EVENT_WRITE
+            if _events != _key.events:
+                self._selector.modify(_stream.socket, _events, _key.data)
+
+        for _key, _events in self._selector.select(timeout):
+            _stream, _callback = _key.data
+            _messages = []
+            if _events & selectors.EVENT_WRITE:
+                _stream.flush()
+            if _events & selectors.EVENT_READ and not _stream.closed:
+                _messages = _stream.read_messages(self._buffer)
+            for _message in _messages:
+                _callback(_message)
+
+            if _stream.closed:
+                self.unregister(_stream)
+                # Make sure the callback hears about it, e.g. after a failed write
+                if len(_messages) == 0 or _messages[-1] is not None:
+                    _callback(None)
+
+    def close(self):
+        self._selector.close()
@@ -30,6 +30,8 @@ import rrdtool
 parser = OptionParser()
 parser.add_option("-s", "--server", type=str,
                   help="server name", dest="server", default='192.168.88.200')
+parser.add_option("-p", "--port", type=int,
+                  help="port number of a kiwi_fleet.py receiver (only used in the RRD file name if not 8073)", dest="port", default=8073)
 parser.add_option("-t", "--timestep", type=int,
                   help="Expected timestep between samples", dest="step", default=300)
 parser.add_option("-z", "--zoom", type=int,
@@ -49,6 +51,9 @@ else:
     filename = None
 
 host = options['server']
+if options['port'] != 8073:
+    # kiwi_fleet names the files of Kiwis on other ports with the port too
+    host = f"{host}_{options['port']}"
 
 zoom = options['zoom']
 
@@ -0,0 +1,319 @@
+#
+#   Helper functions to turn captured waterfall data into RRD / spectra outputs.
+#
+import os.path
+import pathlib
+
+import numpy as np
+import rrdtool
+
+from spectra_helpers import *
+
+from datetime import datetime
+
+# the default number of bins is 1024
+BINS = 1024
+FULL_SPAN = 30000.0 # for a 30MHz kiwiSDR
+DEFAULT_PORT = 8073
+
+
+def calculate_span(zoom, offset_khz, full_span=FULL_SPAN, bins=BINS):
+    """ Work out the span, server offset and frequency limits for a zoom / start frequency pair """
+    if zoom>0:
+        span = int(full_span / 2.**zoom)
+    else:
+        span = int(full_span)
+
+    rbw = span/bins
+    if offset_khz>0:
+    #	offset = (offset_khz-span/2)/(full_span/bins)*2**(zoom)*1000.
+        offset = (offset_khz+100)/(full_span/bins)*2**(4)*1000.
+        offset = max(0, offset)
+    else:
+        offset = 0
+
+    center_freq = int(span/2+offset_khz)
+    lower_freq = center_freq - span/2
+    upper_freq = center_freq + span/2
+
+    return {
+        'zoom': zoom,
+        'offset': offset,
+        'span': span,
+        'rbw': rbw,
+        'center': center_freq,
+        'lower': lower_freq,
+        'upper': upper_freq,
+        'bins': bins
+    }
+
+
+def parse_sweep(sweep):
+    """ Parse a comma separated list of zoom:start_khz windows, e.g. '4:3500,4:7000' """
+    _windows = []
+    for _entry in sweep.split(','):
+        _zoom, _start = _entry.split(':')
+        _windows.append((int(_zoom), int(_start)))
+    return _windows
+
+
+def get_rrd_name(host, window, port=DEFAULT_PORT):
+    """ RRD file name (without extension) for a host and span. A non-default port is included, so Kiwis sharing a host get their own files """
+    if port != DEFAULT_PORT:
+        host = f"{host}_{port}"
+    return f"{host}_{int(window['center'] - window['span']/2)}_{int(window['center'] + window['span']/2)}"
+
+
+def create_rrd(snrfile, step):
+    """ Define RRD database if not done """
+    snrpath = pathlib.Path(snrfile)
+    if snrpath.is_file():
+        return
+
+    rrdtool.create(
+        snrfile,
+        #"--source", snrfile,  #snrfile, remove comment and not if recreating
+        #"--start", "now",     #start time, uses default now - 10s
+        #"--step", "0.3",                    #timestep, adjust crontab accordingly
+        f"DS:median:GAUGE:{step*10}:-150:-30",  #Expect readings every 10 step
+        f"DS:p95:GAUGE:{step*10}:-150:-30",
+        f"DS:snr:GAUGE:{step*10}:0:60",
+        f"RRA:AVERAGE:0.5:5m:1d",   #Daily average
+        f"RRA:AVERAGE:0.5:30m:1w",  #Weekly average
+        f"RRA:AVERAGE:0.5:3h:30d",  #Monthly average
+        f"RRA:MAX:0.1:3h:30d",      #Monthly max
+        f"RRA:MIN:0.1:3h:30d",      #Monthly min
+        f"RRA:LAST:0.5:1:1")        #Last value
+    print("RRD database created: ", snrfile)
+
+
+def update_rrd(snrfile, median, p95):
+    """ Push a median / p95 / SNR triple into the RRD file """
+    data = format("N:%3.1f:%3.1f:%2.2f" % (median,p95,p95-median))
+
+    try:
+        rrdtool.update(snrfile, data)
+    except rrdtool.error as e:
+        print("RRD update error: ", e)
+    lt = rrdtool.last(snrfile)
+    ld = datetime.fromtimestamp(lt)
+    print("RRD file %s updated: %s (Unix time: %i)" % (snrfile,ld,lt))
+
+
+# Amateur HF bands, in kHz
+HAM_BANDS = [
+    ('160m', 1800, 2000),
+    ('80m', 3500, 4000),
+    ('60m', 5250, 5450),
+    ('40m', 7000, 7300),
+    ('30m', 10100, 10150),
+    ('20m', 14000, 14350),
+    ('17m', 18068, 18168),
+    ('15m', 21000, 21450),
+    ('12m', 24890, 24990),
+    ('10m', 28000, 29700)
+]
+
+# Shortwave broadcast bands, in kHz
+BROADCAST_BANDS = [
+    ('120m', 2300, 2495),
+    ('90m', 3200, 3400),
+    ('75m', 3900, 4000),
+    ('60mb', 4750, 5060),
+    ('49m', 5900, 6200),
+    ('41m', 7200, 7450),
+    ('31m', 9400, 9900),
+    ('25m', 11600, 12100),
+    ('22m', 13570, 13870),
+    ('19m', 15100, 15800),
+    ('16m', 17480, 17900),
+    ('15mb', 18900, 19020),
+    ('13m', 21450, 21850),
+    ('11m', 25670, 26100)
+]
+
+BAND_PRESETS = {'ham': HAM_BANDS, 'broadcast': BROADCAST_BANDS}
+
+
+def parse_bands(bands):
+    """ Parse a comma separated list of name:lower-upper (kHz) bands, or a preset name, e.g. 'ham' or '40m:7000-7300' """
+    if bands == 'none':
+        return []
+    _bands = []
+    for _entry in bands.split(','):
+        if _entry in BAND_PRESETS:
+            _bands.extend(BAND_PRESETS[_entry])
+            continue
+        _name, _range = _entry.split(':')
+        _lower, _upper = _range.split('-')
+        # RRD data source names are limited to 19 characters, and get a _median suffix
+        if not _name.replace('_', '').isalnum() or len(_name) > 12:
+            raise ValueError("Band names must be up to 12 letters, digits or underscores: %s" % _name)
+        _bands.append((_name, float(_lower), float(_upper)))
+    return _bands
+
+
+class BandSegments(object):
+    """ Bin index ranges of a set of named bands within a capture window.
+
+    The ranges are worked out once, and the bins of every band are gathered into one
+    contiguous array, so per-band statistics come from a single sort of that array
+    rather than a loop over the bands.
+    Bands that do not overlap the window are dropped.
+    """
+
+    def __init__(self, bands, window):
+        _bins = window['bins']
+        _scale = _bins / (window['upper'] - window['lower'])
+
+        self.names = []
+        _starts = []
+        _stops = []
+        for _name, _lower, _upper in bands:
+            _start = int(np.clip(np.floor((_lower - window['lower']) * _scale), 0, _bins))
+            _stop = int(np.clip(np.ceil((_upper - window['lower']) * _scale), 0, _bins))
+            if _stop > _start:
+                self.names.append(_name)
+                _starts.append(_start)
+                _stops.append(_stop)
+
+        _lengths = np.array(_stops, dtype=np.intp) - np.array(_starts, dtype=np.intp)
+        self._lengths = _lengths
+        # Where each band starts in the gathered array
+        self._offsets = np.concatenate(([0], np.cumsum(_lengths)[:-1])).astype(np.intp) if len(_lengths) else _lengths
+        # Bin indices of all bands, one after the other, and the band each one belongs to
+        self._index = np.concatenate([np.arange(_a, _b) for _a, _b in zip(_starts, _stops)]) if len(_lengths) else _lengths
+        self._segment = np.repeat(np.arange(len(_lengths)), _lengths)
+
+    def __len__(self):
+        return len(self.names)
+
+    def percentiles(self, spectrum, qs):
+        """ List of q-th percentiles (across bins) of each band for each q in qs, interpolated as np.percentile does """
+        # Sort within each band in one go, by sorting on (band, value), and read every q from that
+        _values = spectrum[self._index]
+        _sorted = _values[np.lexsort((_values, self._segment))]
+
+        _results = []
+        for _q in qs:
+            _rank = self._offsets + (_q/100.0) * (self._lengths - 1)
+            _lower = np.floor(_rank).astype(np.intp)
+            _upper = np.ceil(_rank).astype(np.intp)
+            _results.append(_sorted[_lower] + (_sorted[_upper] - _sorted[_lower]) * (_rank - _lower))
+        return _results
+
+    def statistics(self, spectrum):
+        """ Per-band (median, p95) arrays for a spectrum """
+        return tuple(self.percentiles(spectrum, (50, 95)))
+
+
+def get_band_rrd_name(snrfile):
+    """ Per-band data is saved to an RRD file appended with _bands """
+    # Host names contain dots, so only split off the extension
+    _base, _ext = os.path.splitext(snrfile)
+    return _base + "_bands" + _ext
+
+
+def create_band_rrd(snrfile, step, names):
+    """ Define the per-band RRD database if not done. Each band gets its own median / p95 / snr sources """
+    snrpath = pathlib.Path(snrfile)
+    if snrpath.is_file():
+        return
+
+    _sources = []
+    for _name in names:
+        _sources.append(f"DS:{_name}_median:GAUGE:{step*10}:-150:-30")
+        _sources.append(f"DS:{_name}_p95:GAUGE:{step*10}:-150:-30")
+        _sources.append(f"DS:{_name}_snr:GAUGE:{step*10}:0:60")
+
+    rrdtool.create(
+        snrfile,
+        *_sources,
+        f"RRA:AVERAGE:0.5:5m:1d",   #Daily average
+        f"RRA:AVERAGE:0.5:30m:1w",  #Weekly average
+        f"RRA:AVERAGE:0.5:3h:30d",  #Monthly average
+        f"RRA:MAX:0.1:3h:30d",      #Monthly max
+        f"RRA:MIN:0.1:3h:30d",      #Monthly min
+        f"RRA:LAST:0.5:1:1")        #Last value
+    print("RRD database created: ", snrfile)
+
+
+def update_band_rrd(snrfile, names, median, p95):
+    """ Push the per-band median / p95 / SNR values into the per-band RRD file """
+    _template = ":".join(f"{_name}_median:{_name}_p95:{_name}_snr" for _name in names)
+    data = "N" + "".join(":%3.1f:%3.1f:%2.2f" % (_m, _p, _p - _m) for _m, _p in zip(median, p95))
+
+    try:
+        rrdtool.update(snrfile, "--template", _template, data)
+    except rrdtool.error as e:
+        print("RRD update error: ", e)
+
+
+def get_suffixed_filename(filename, suffix):
+    """ Extra spectra data is saved to a filename appended with a suffix, e.g. _peak """
+    # Only split off the extension, the path may have dots in it, and there may be no extension at all
+    _base, _ext = os.path.splitext(filename)
+    return _base + "_" + suffix + _ext
+
+
+def get_peak_filename(filename):
+    """ Peak data is saved to a filename appended with _peak """
+    return get_suffixed_filename(filename, "peak")
+
+
+def get_percentile_filename(filename, q):
+    """ Time-percentile data is saved to a filename appended with _p<q>, e.g. _p10 """
+    return get_suffixed_filename(filename, f"p{q:g}")
+
+
+def parse_percentiles(percentiles):
+    """ Parse a comma separated list of percentiles, e.g. '10,90' """
+    if percentiles == 'none':
+        return []
+    return [float(_q) for _q in percentiles.split(',')]
+
+
+def write_results(snrfile, spectra, window, accumulator, percentiles=[], linear_average=False, bands=None):
+    """ Write out the spectra and RRD data for a capture window held in a WaterfallAccumulator.
+
+    If percentiles are given, the accumulator must have been created with a histogram,
+    and per-bin time-percentile spectra are saved alongside the average and peak data.
+    If linear_average is set, the accumulator must have been created with linear=True,
+    and the average spectrum is taken in the power domain rather than in dB.
+    If bands (a BandSegments) is given, per-band median / p95 / SNR values are written to the _bands RRD file.
+    """
+    bins = window['bins']
+
+    if linear_average:
+        avg_wf = accumulator.mean_power() # average power over time
+    else:
+        avg_wf = accumulator.mean() # average over time
+    max_wf = accumulator.max() # Peak values
+
+    wf_dbm = accumulator.peak_power_sum() - 3
+
+    print("Power Sum: %.3f dBm (ADC Overload at -17 dBm)" % wf_dbm)
+
+    if spectra != 'none':
+        append_to_file(spectra, window['lower'], window['upper'], bins, avg_wf)
+
+        # Save out peak data
+        append_to_file(get_peak_filename(spectra), window['lower'], window['upper'], bins, max_wf)
+
+        # Save out time-percentile data (e.g. the noise floor)
+        for _q in percentiles:
+            append_to_file(get_percentile_filename(spectra, _q), window['lower'], window['upper'], bins, accumulator.percentile(_q))
+
+    p95 = np.percentile(avg_wf, 95)
+    median = np.percentile(avg_wf, 50)
+
+    print("Average SNR computation...")
+    print("Waterfall with %d bins: median= %f dB, p95= %f dB - SNR= %f rbw= %f kHz" % (bins, median, p95,p95-median, window['rbw']))
+
+    update_rrd(snrfile, median, p95)
+
+    if bands:
+        band_median, band_p95 = bands.statistics(avg_wf)
+        for _name, _median, _p95 in zip(bands.names, band_median, band_p95):
+            print("Band %s: median= %f dB, p95= %f dB - SNR= %f" % (_name, _median, _p95, _p95 - _median))
+        update_band_rrd(get_band_rrd_name(snrfile), bands.names, band_median, band_p95)
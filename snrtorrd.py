@@ -8,245 +8,334 @@ Original Author: Olaf - LA3RK
 
 # Yeah this is all a bit of a mess.
 
-import numpy as np
-import struct
-
-from spectra_helpers import *
-
-import datetime
-import logging
-import socket
-import struct
+import select
+import sys
 import time
-from datetime import datetime
-from suntime import Sun
-import pathlib
 
-import wsclient
+from optparse import OptionParser
 
-import mod_pywebsocket.common
-from mod_pywebsocket.stream import Stream
-from mod_pywebsocket.stream import StreamOptions
+from archive_helpers import *
+from kiwi_helpers import *
+from snr_helpers import *
+
+
+def parse_options():
+    parser = OptionParser()
+    parser.add_option("-f", "--file", dest="filename", type=str,
+                      help="append raw waterfall data to archive FILE", metavar="FILE", default='none')
+    parser.add_option("-s", "--server", type=str,
+                      help="server name", dest="server", default='192.168.88.200')
+    parser.add_option("-p", "--port", type=int,
+                      help="port number", dest="port", default=DEFAULT_PORT)
+    parser.add_option("-a", "--password", type=str,
+                      help="server password", dest="password", default='NONE')
+    parser.add_option("-l", "--length", type=int,
+                      help="how many samples to draw from the server", dest="length", default=100)
+    parser.add_option("-t", "--timestep", type=int,
+                      help="Expected timestep between samples", dest="step", default=300)
+    parser.add_option("--timeout", type=float,
+                      help="Connection Timeout", dest="timeout", default=1)
+    parser.add_option("-z", "--zoom", type=int,
+                      help="zoom factor", dest="zoom", default=0)
+    parser.add_option("-o", "--offset", type=int,
+                      help="start frequency in kHz", dest="start", default=0)
+    parser.add_option("-v", "--verbose", type=int,
+                      help="whether to print progress and debug info", dest="verbosity", default=0)
+    parser.add_option("--spectra", type=str,
+                      help="Spectra Output File (csv, or binary if named *.spectra)", dest="spectra", default='none')
+    parser.add_option("--percentiles", type=str,
+                      help="Comma separated per-bin time-percentiles to save with the spectra, e.g. 10,90", dest="percentiles", default='none')
+    parser.add_option("--linear", action="store_true",
+                      help="average the spectra in the linear power domain rather than in dB", dest="linear", default=False)
+    parser.add_option("--compress", action="store_true",
+                      help="request the compressed (ADPCM) waterfall to save bandwidth", dest="compress", default=False)
+    parser.add_option("--sweep", type=str,
+                      help="Comma separated list of zoom:start_khz windows to capture in turn on one connection, e.g. 4:3500,4:7000", dest="sweep", default='none')
+    parser.add_option("--settle", type=int,
+                      help="Waterfall lines to discard after retuning in a sweep", dest="settle", default=5)
+    parser.add_option("--bands", type=str,
+                      help="Also record SNR for these bands: a preset (ham, broadcast) and/or name:lower-upper kHz entries, comma separated", dest="bands", default='none')
+    parser.add_option("--reject_stale", action="store_true",
+                      help="Discard repeated or out of order waterfall lines (only if the sequence number advances per line)", dest="reject_stale", default=False)
+    parser.add_option("--adaptive", type=float,
+                      help="Stop capturing once the median and p95 are known to within this many dB (95%% confidence). 0 disables.", dest="adaptive", default=0)
+    parser.add_option("--min_length", type=int,
+                      help="Minimum number of samples in an adaptive capture", dest="min_length", default=20)
+    parser.add_option("--max_length", type=int,
+                      help="Maximum number of samples in an adaptive capture", dest="max_length", default=1000)
+    parser.add_option("-d", "--daemon", action="store_true",
+                      help="keep the connection open and capture every TIMESTEP seconds", dest="daemon", default=False)
+    parser.add_option("--keepalive", type=float,
+                      help="Seconds between keepalives while idle in daemon mode", dest="keepalive", default=5)
+
+    options = vars(parser.parse_args()[0])
+    options['percentiles'] = parse_percentiles(options['percentiles'])
+    options['bands'] = parse_bands(options['bands'])
+
+    return options
+
+
+def connect(options, window):
+    """ Open the stream and start the waterfall. Returns (socket, stream) or None on failure """
+    host = options['server']
+    port = options['port']
+
+    print("Trying to contact server...")
+    try:
+        mysocket, mystream = open_stream(host, port, options['timeout'])
+    except Exception as e:
+        print("Failed to connect: %s" % e)
+        return None
+    print("Data stream active...")
 
-from optparse import OptionParser
+    start_waterfall(mystream, options['password'], window['zoom'], window['offset'], options['compress'])
+    return mysocket, mystream
 
-import rrdtool
-import sys
 
-parser = OptionParser()
-#parser.add_option("-f", "--file", dest="filename", type=str,
-#                  help="write waterfall data to binary FILE", metavar="FILE")
-parser.add_option("-s", "--server", type=str,
-                  help="server name", dest="server", default='192.168.88.200')
-parser.add_option("-p", "--port", type=int,
-                  help="port number", dest="port", default=8073)
-parser.add_option("-a", "--password", type=str,
-                  help="server password", dest="password", default='NONE')
-parser.add_option("-l", "--length", type=int,
-                  help="how many samples to draw from the server", dest="length", default=100)
-parser.add_option("-t", "--timestep", type=int,
-                  help="Expected timestep between samples", dest="step", default=300)
-parser.add_option("--timeout", type=float,
-                  help="Connection Timeout", dest="timeout", default=1)
-parser.add_option("-z", "--zoom", type=int,
-                  help="zoom factor", dest="zoom", default=0)
-parser.add_option("-o", "--offset", type=int,
-                  help="start frequency in kHz", dest="start", default=0)
-parser.add_option("-v", "--verbose", type=int,
-                  help="whether to print progress and debug info", dest="verbosity", default=0)
-parser.add_option("--spectra", type=str,
-                  help="Spectra Output File (csv)", dest="spectra", default='none')
-
-options = vars(parser.parse_args()[0])
-
-if 'filename' in options:
-    filename = options['filename']
-else:
-    filename = None
-
-host = options['server']
-port = options['port']
-print("KiwiSDR Server: %s:%d" % (host,port))
-# the default number of bins is 1024
-bins = 1024
-print("Number of waterfall bins: %d" % bins)
-
-zoom = options['zoom']
-print("Zoom factor:", zoom)
-
-offset_khz = options['start'] # this is offset in kHz
-
-full_span = 30000.0 # for a 30MHz kiwiSDR
-if zoom>0:
-    span = int(full_span / 2.**zoom)
-else:
-	span = int(full_span)
-
-rbw = span/bins
-if offset_khz>0:
-#	offset = (offset_khz-span/2)/(full_span/bins)*2**(zoom)*1000.
-	offset = (offset_khz+100)/(full_span/bins)*2**(4)*1000.
-	offset = max(0, offset)
-else:
-	offset = 0
-
-center_freq = int(span/2+offset_khz)
-lower_freq = center_freq - span/2
-upper_freq = center_freq + span/2
-print("Start/End: %.2f / %.2f kHz" % (lower_freq, upper_freq))
-snrname = f"{host}_{int(center_freq - span/2)}_{int(center_freq + span/2)}"
-snrfile = snrname + ".rrd"
-print("Current rrd file: ", snrfile)
-
-snrpath = pathlib.Path(snrfile)
-step = options['step']         #Seconds between samples
-print(step)
-#daystep = 2 * step     #Daily graph stepsize
-#weekstep = 7 * daystep    #Weekly graph stepsize
-#monthstep = 7 * weekstep  #Monthly graph stepsize
-# Define RRD database if not done
-if not snrpath.is_file():
-    rrdtool.create(
-        snrfile,
-        #"--source", snrfile,  #snrfile, remove comment and not if recreating
-        #"--start", "now",     #start time, uses default now - 10s
-        #"--step", "0.3",                    #timestep, adjust crontab accordingly
-        f"DS:median:GAUGE:{step*10}:-150:-30",  #Expect readings every 10 step
-        f"DS:p95:GAUGE:{step*10}:-150:-30", 
-        f"DS:snr:GAUGE:{step*10}:0:60",
-        f"RRA:AVERAGE:0.5:5m:1d",   #Daily average
-        f"RRA:AVERAGE:0.5:30m:1w",  #Weekly average
-        f"RRA:AVERAGE:0.5:3h:30d",  #Monthly average
-        f"RRA:MAX:0.1:3h:30d",      #Monthly max
-        f"RRA:MIN:0.1:3h:30d",      #Monthly min
-        f"RRA:LAST:0.5:1:1")        #Last value
-    print("RRD database created: ", snrfile)
-
-now = str.encode(str(datetime.now()))
-header = [center_freq, span, now]
-#print("Header: ", center_freq, span, now)
-#header format; unsigned int (I), unsigned int (i), 26 char array
-header_bin = struct.pack("II26s", *header)
-
-print("Trying to contact server...")
-try:
-    mysocket = socket.socket()
-    mysocket.connect((host, port))
-    mysocket.settimeout(options['timeout'])
-except:
-    print("Failed to connect....exit")
-    exit(110)   
-print("Socket open...")
-
-uri = '/%d/%s' % (int(time.time()), 'W/F')
-handshake = wsclient.ClientHandshakeProcessor(mysocket, host, port)
-handshake.handshake(uri)
-
-request = wsclient.ClientRequest(mysocket)
-request.ws_version = mod_pywebsocket.common.VERSION_HYBI13
-
-stream_option = StreamOptions()
-stream_option.mask_send = True
-stream_option.unmask_receive = False
-
-mystream = Stream(request, stream_option)
-print("Data stream active...")
-
-# send a sequence of messages to the server, hardcoded for now
-# max wf speed, no compression
-_msg_1 = 'SET auth t=kiwi p='
-if options['password'] != 'NONE':
-    _msg_1 += options['password']
-
-msg_list = [_msg_1, 'SET zoom=%d start=%d'%(zoom,offset),\
-'SET maxdb=0 mindb=-100', 'SET wf_speed=4', 'SET wf_comp=0']
-for msg in msg_list:
-    mystream.send_message(msg)
-print("Starting to retrieve waterfall data...")
-# number of samples to draw from server
-length = options['length']
-# create a numpy array to contain the waterfall data
-wf_data = np.zeros((length, bins))
-binary_wf_list = []
-time = 0
-while time<length:
-    # receive one msg from server
-    try:
-        tmp = mystream.receive_message()
-    except:
-        print("Timeout waiting for data!")
-        break
+def make_dispatcher(options):
+    """ Dispatcher for the non-waterfall messages seen while capturing.
 
-    if str.encode("W/F") in tmp: # this is one waterfall line
-        tmp = tmp[16:] # remove some header from each msg
+    Status messages saying the Kiwi is busy, down or has rejected us raise KiwiServerError at once,
+    rather than leaving us to wait for the receive timeout.
+    """
+    def _status_message(body, header):
         if options['verbosity']:
-            print(time,)
-        #spectrum = np.array(struct.unpack('%dB'%len(tmp), tmp) ) # convert from binary data to uint8
-        spectrum = np.ndarray(len(tmp), dtype='B', buffer=tmp) # convert from binary data to uint8
-        if filename:
-            binary_wf_list.append(tmp) # append binary data to be saved to file
-        #wf_data[time, :] = spectrum-255 # mirror dBs
-        wf_data[time, :] = spectrum
-        wf_data[time, :] = -(255 - wf_data[time, :])  # dBm
-        wf_data[time, :] = wf_data[time, :] - 13  # typical Kiwi wf cal - NEED TO REVISIT THIS
-        time += 1
-    else: 
-        # this is chatter between client and server
-        pass
-
-if time < length:
-    print("Did not gather all required samples, abandoning.")
-
-    # Append dummy entry
-    if options['spectra'] != 'none':
-        append_dummy_entry(options['spectra'],lower_freq, upper_freq, bins)
-    
-    sys.exit(1)
-
-
-try:
-    mystream.close_connection(mod_pywebsocket.common.STATUS_GOING_AWAY)
-    mysocket.close()
-except Exception as e:
-    print("exception: %s" % e)
-
-avg_wf = np.mean(wf_data, axis=0) # average over time
-max_wf = np.max(wf_data, axis=0) # Peak values
-
-wf_dbm = 10*np.log10(np.sum(10**(max_wf/10.0))) - 3
-
-print("Power Sum: %.3f dBm (ADC Overload at -17 dBm)" % wf_dbm)
-
-if options['spectra'] != 'none':
-    append_to_file(options['spectra'],lower_freq, upper_freq, bins, avg_wf)
-
-    # Save out peak data
-    _max_filename = options['spectra'].split('.')[0] + "_peak." + options['spectra'].split('.')[1]
-    append_to_file(_max_filename,lower_freq, upper_freq, bins, max_wf)
-    # _output = datetime.utcnow().isoformat() + "Z"
-    # for _data in avg_wf:
-    #     _output += "," + "%.1f" % _data
-    
-    # _outspectra = open(options['spectra'],'a')
-    # _outspectra.write(_output+"\n")
-    # _outspectra.close()
-
-p95 = np.percentile(avg_wf, 95)
-median = np.percentile(avg_wf, 50)
-
-print("Average SNR computation...")
-print("Waterfall with %d bins: median= %f dB, p95= %f dB - SNR= %f rbw= %f kHz" % (bins, median, p95,p95-median, rbw))
-snr = p95-median
-data = format("N:%3.1f:%3.1f:%2.2f" % (median,p95,p95-median))
-
-
-try:	
-    rrdtool.update(snrfile, data)
-except rrdtool.error as e:
-    print("RRD update error: ", e)
-lt = rrdtool.last(snrfile)
-ft = rrdtool.first(snrfile)
-ld = datetime.fromtimestamp(lt)
-fd = datetime.fromtimestamp(ft)
-print("RRD file %s updated: %s (Unix time: %i)" % (snrfile,ld,lt))
+            print("Server message: %s" % bytes(body).decode('utf-8', 'replace'))
+        return check_status_message(body)
+
+    dispatcher = MessageDispatcher()
+    dispatcher.register(MSG_TAG, _status_message)
+    return dispatcher
+
+
+def capture(options, window, mystream):
+    """ Gather one capture window. Returns a WaterfallAccumulator, or None if we did not get enough lines """
+    if options['adaptive'] > 0:
+        # Capture until the statistics settle, within the min/max bounds
+        length = options['max_length']
+        required = options['min_length']
+        converged = lambda acc: acc.count >= required and snr_converged(acc, options['adaptive'], options['linear'])
+    else:
+        length = options['length']
+        required = length
+        converged = None
+    accumulator = WaterfallAccumulator(window['bins'], histogram=len(options['percentiles']) > 0, linear=options['linear'], variance=converged is not None)
+
+    archive = None
+    if window['archive'] != 'none':
+        archive = WaterfallArchive(window['archive'], window)
+
+    tracker = SequenceTracker(options['reject_stale'])
+
+    print("Starting to retrieve waterfall data...")
+    try:
+        count = capture_waterfall(mystream, length, accumulator, options['verbosity'], compression=options['compress'], converged=converged, archive=archive, dispatcher=make_dispatcher(options), tracker=tracker)
+    finally:
+        if archive is not None:
+            archive.close()
+    print("Sequence: %s" % tracker.summary())
+    if converged:
+        print("Adaptive capture used %d samples" % count)
+
+    if count < required:
+        print("Did not gather all required samples, abandoning.")
+
+        # Append dummy entry
+        if window['spectra'] != 'none':
+            append_dummy_entry(window['spectra'], window['lower'], window['upper'], window['bins'])
+        return None
+
+    return accumulator
+
+
+def capture_windows(options, windows, mystream, retune_first):
+    """ Capture each window in turn on an open stream, and write out the results.
+
+    Returns False if a capture failed, in which case the remaining windows are abandoned.
+    """
+    for _i, window in enumerate(windows):
+        if _i > 0 or retune_first:
+            print("Retuning to %.2f / %.2f kHz" % (window['lower'], window['upper']))
+            set_waterfall_zoom(mystream, window['zoom'], window['offset'])
+            # Lines already in flight are from the previous window
+            if capture_waterfall(mystream, options['settle'], None, ring=WaterfallRing(1, window['bins']), compression=options['compress'], dispatcher=make_dispatcher(options)) < options['settle']:
+                print("Did not receive settling lines, abandoning.")
+                return False
+
+        accumulator = capture(options, window, mystream)
+        if accumulator is None:
+            return False
+
+        write_results(window['snrfile'], window['spectra'], window, accumulator, options['percentiles'], options['linear'], window['bands'])
+
+    return True
+
+
+def idle(options, mysocket, mystream, until, keepalive):
+    """ Drain server chatter and send keepalives until the next capture is due.
+
+    Status messages still go through the dispatcher, so being told the Kiwi is down
+    or redirecting us raises KiwiServerError now rather than at the next capture.
+    """
+    _dispatcher = make_dispatcher(options)
+    _next_keepalive = 0
+    while True:
+        _now = time.time()
+        if _now >= until:
+            return True
+
+        if _now >= _next_keepalive:
+            send_keepalive(mystream)
+            _next_keepalive = _now + keepalive
+
+        # Messages already pulled into the stream's read-ahead buffer won't show up in select()
+        if mystream.get_buffered_length() > 0:
+            _ready = True
+        else:
+            _ready, _, _ = select.select([mysocket], [], [], min(until, _next_keepalive) - _now)
+        if _ready:
+            # Status messages or a few stale waterfall lines, only the status matters.
+            _message = mystream.receive_message()
+            if _message is None:
+                return False
+            _dispatcher.dispatch(_message)
+
+
+def run_once(options, windows):
+    _conn = connect(options, windows[0])
+    if _conn is None:
+        print("Failed to connect....exit")
+        sys.exit(110)
+    mysocket, mystream = _conn
 
+    try:
+        if not capture_windows(options, windows, mystream, False):
+            sys.exit(1)
+    except KiwiServerError as e:
+        print("Server turned us away: %s" % e)
+        close_stream(mysocket, mystream)
+        sys.exit(1)
+
+    close_stream(mysocket, mystream)
+
+
+def run_daemon(options, windows):
+    """ Keep the connection open and capture the windows every timestep seconds """
+    step = options['step']
+    _conn = None
+    _next_capture = time.time()
+
+    while True:
+        if _conn is None:
+            _conn = connect(options, windows[0])
+            if _conn is None:
+                # Try again at the next slot rather than hammering the server.
+                _next_capture += step
+                time.sleep(max(0, _next_capture - time.time()))
+                continue
+            _retune = False
+        mysocket, mystream = _conn
+
+        try:
+            set_waterfall_speed(mystream, WF_SPEED_MAX)
+            if capture_windows(options, windows, mystream, _retune):
+                set_waterfall_speed(mystream, WF_SPEED_OFF)
+                # We are left tuned to the last window
+                _retune = len(windows) > 1
+            else:
+                close_stream(mysocket, mystream)
+                _conn = None
+        except KiwiServerError as e:
+            print("Server turned us away: %s" % e)
+            close_stream(mysocket, mystream)
+            _conn = None
+            if e.reason == KIWI_BAD_PASSWORD:
+                # Retrying won't help
+                sys.exit(1)
+        except Exception as e:
+            print("Capture failed: %s" % e)
+            close_stream(mysocket, mystream)
+            _conn = None
+
+        # Schedule on a fixed grid, skipping any slots we overran.
+        _next_capture += step
+        while _next_capture < time.time():
+            _next_capture += step
+
+        if _conn is None:
+            time.sleep(max(0, _next_capture - time.time()))
+            continue
+
+        try:
+            if not idle(options, mysocket, mystream, _next_capture, options['keepalive']):
+                print("Server closed the connection, reconnecting.")
+                close_stream(mysocket, mystream)
+                _conn = None
+        except KiwiServerError as e:
+            print("Server turned us away: %s" % e)
+            close_stream(mysocket, mystream)
+            _conn = None
+            if e.reason == KIWI_BAD_PASSWORD:
+                sys.exit(1)
+        except Exception as e:
+            print("Connection lost while idle: %s" % e)
+            close_stream(mysocket, mystream)
+            _conn = None
+
+        if _conn is None:
+            # Reconnect at the next slot rather than straight away
+            time.sleep(max(0, _next_capture - time.time()))
+
+
+def main():
+    options = parse_options()
+
+    host = options['server']
+    port = options['port']
+    print("KiwiSDR Server: %s:%d" % (host,port))
+    print("Number of waterfall bins: %d" % BINS)
+
+    if options['sweep'] != 'none':
+        _spans = parse_sweep(options['sweep'])
+    else:
+        _spans = [(options['zoom'], options['start'])]
+
+    step = options['step']         #Seconds between samples
+    print(step)
+
+    windows = []
+    for zoom, start in _spans:
+        print("Zoom factor:", zoom)
+
+        window = calculate_span(zoom, start)
+        print("Start/End: %.2f / %.2f kHz" % (window['lower'], window['upper']))
+        window['snrfile'] = get_rrd_name(host, window) + ".rrd"
+        print("Current rrd file: ", window['snrfile'])
+        create_rrd(window['snrfile'], step)
+
+        # Work out which bins belong to each band once, up front
+        window['bands'] = BandSegments(options['bands'], window)
+        if len(window['bands']) > 0:
+            print("Bands in window: %s" % ", ".join(window['bands'].names))
+            create_band_rrd(get_band_rrd_name(window['snrfile']), step, window['bands'].names)
+
+        # Each window of a sweep gets its own spectra files
+        window['spectra'] = options['spectra']
+        if len(_spans) > 1 and options['spectra'] != 'none':
+            window['spectra'] = get_suffixed_filename(options['spectra'], f"{int(window['lower'])}_{int(window['upper'])}")
+
+        # and its own raw waterfall archive
+        window['archive'] = options['filename']
+        if len(_spans) > 1 and options['filename'] != 'none':
+            window['archive'] = get_suffixed_filename(options['filename'], f"{int(window['lower'])}_{int(window['upper'])}")
+
+        windows.append(window)
+
+    if options['daemon']:
+        run_daemon(options, windows)
+    else:
+        run_once(options, windows)
+
+
+if __name__ == "__main__":
+    main()
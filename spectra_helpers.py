@@ -2,10 +2,57 @@
 #   Helper functions to deal with saved spectra data.
 #
 import datetime
+import fcntl
 import os.path
+import shutil
+import struct
 import numpy as np
 from dateutil.parser import parse
 
+# Binary spectra logs are picked by their file extension, anything else is written as CSV.
+#
+# A binary log is a header carrying the same fields as the CSV header line, then one
+# fixed-size record per spectrum, so it can be memory-mapped rather than parsed:
+#   magic, format version, lower freq, upper freq, bins
+BINARY_SPECTRA_EXTENSION = ".spectra"
+BINARY_SPECTRA_MAGIC = b"KIWISP"
+BINARY_SPECTRA_VERSION = 1
+BINARY_SPECTRA_HEADER = struct.Struct("<6sHddI")
+# Bins are stored as int16 hundredths of a dB, with the most negative value marking a dummy entry.
+BINARY_SPECTRA_SCALE = 100.0
+BINARY_SPECTRA_MISSING = -32768
+DUMMY_VALUE = -999.0
+
+# Rows of a CSV spectra file converted to numbers at a time
+SPECTRA_PARSE_BLOCK = 256
+# Bytes read at a time when searching back from the end of a CSV spectra file
+SPECTRA_SEEK_BLOCK = 65536
+
+# CSV spectra files get a sidecar index, holding the byte offset of a row every so often,
+# so reads of any time range can seek straight to it.
+SPECTRA_INDEX_EXTENSION = ".idx"
+SPECTRA_INDEX_INTERVAL = 3600
+SPECTRA_INDEX_DTYPE = np.dtype([('time', '<i8'), ('offset', '<i8')])
+
+SPECTRA_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Bytes copied at a time when clipping a spectra file
+SPECTRA_COPY_BLOCK = 1048576
+
+
+def is_binary_spectra_file(filename):
+    return os.path.splitext(filename)[1] == BINARY_SPECTRA_EXTENSION
+
+
+def spectra_time_to_epoch(time):
+    """ Convert a tz-aware datetime to integer unix microseconds """
+    return (time - SPECTRA_EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def binary_spectra_dtype(bins):
+    """ Record layout of a binary spectra log: unix time in microseconds, and the spectrum in centi-dB """
+    return np.dtype([('time', '<i8'), ('spectrum', '<i2', (int(bins),))])
+
 
 def create_new_file(filename, lower_freq, upper_freq, bins):
     """ Create a new spectra data file with a header """
@@ -15,7 +62,52 @@ def create_new_file(filename, lower_freq, upper_freq, bins):
     _f.close()
 
 
+def create_new_binary_file(filename, lower_freq, upper_freq, bins):
+    """ Create a new binary spectra log with a header """
+    _f = open(filename,'wb')
+    _f.write(BINARY_SPECTRA_HEADER.pack(BINARY_SPECTRA_MAGIC, BINARY_SPECTRA_VERSION, lower_freq, upper_freq, int(bins)))
+    _f.close()
+
+
+def get_binary_file_header(filename):
+    _f = open(filename,'rb')
+    _data = _f.read(BINARY_SPECTRA_HEADER.size)
+    _f.close()
+
+    if len(_data) < BINARY_SPECTRA_HEADER.size:
+        print("Not a Spectra File!")
+        return None
+    _magic, _version, _lower_freq, _upper_freq, _bins = BINARY_SPECTRA_HEADER.unpack(_data)
+    if _magic != BINARY_SPECTRA_MAGIC or _version != BINARY_SPECTRA_VERSION:
+        print("Not a Spectra File!")
+        return None
+
+    return (_lower_freq, _upper_freq, float(_bins))
+
+
+def read_binary_records(filename):
+    """ Memory-map the records of a binary spectra log. Returns (header, records), or None if unreadable.
+
+    records is a structured array with 'time' (int64 unix microseconds) and
+    'spectrum' ((rows, bins) int16 centi-dB) fields.
+    """
+    _header = get_binary_file_header(filename)
+    if _header is None:
+        return None
+
+    _dtype = binary_spectra_dtype(_header[2])
+    # Ignore a partial record at the end, e.g. one still being written
+    _rows = (os.path.getsize(filename) - BINARY_SPECTRA_HEADER.size) // _dtype.itemsize
+    if _rows == 0:
+        return _header, np.zeros(0, dtype=_dtype)
+
+    return _header, np.memmap(filename, dtype=_dtype, mode='r', offset=BINARY_SPECTRA_HEADER.size, shape=(_rows,))
+
+
 def get_file_header(filename):
+    if is_binary_spectra_file(filename):
+        return get_binary_file_header(filename)
+
     _f = open(filename,'r')
     try:
         _header = _f.readline()[1:] # Strip off leading #
@@ -35,69 +127,398 @@ def get_file_header(filename):
         return None
 
 
-def read_spectra_file(filename, time_limit = None):
-    """ Attempt to read in a spectra data file """
+def read_binary_spectra_file(filename, start_time = None, end_time = None):
+    """ Read in the records of a binary spectra log between two times, returning the same data as read_spectra_file """
+    _data = read_binary_records(filename)
+
+    if _data is None:
+        return None
+    _header, _records = _data
+
+    # Records are appended in time order, so the window can be found by bisection
+    _start = 0 if start_time is None else np.searchsorted(_records['time'], spectra_time_to_epoch(start_time), side='left')
+    _end = len(_records) if end_time is None else np.searchsorted(_records['time'], spectra_time_to_epoch(end_time), side='right')
+    _records = _records[_start:_end]
+
+    _raw = _records['spectrum']
+    _spectra = _raw / BINARY_SPECTRA_SCALE
+    _spectra[_raw == BINARY_SPECTRA_MISSING] = DUMMY_VALUE
+
+    _times = [SPECTRA_EPOCH + datetime.timedelta(microseconds=int(_t)) for _t in _records['time']]
+
+    return {'lower': _header[0], 'upper':_header[1], 'time':_times, 'spectra':_spectra}
+
+
+def parse_spectra_time(text):
+    """ Parse a spectra file timestamp, as written by append_to_file (isoformat() + "Z") """
+    try:
+        _time = datetime.datetime.fromisoformat(text.rstrip('Z'))
+    except ValueError:
+        # Not one of ours, fall back to the slow but lenient parser
+        _time = parse(text)
+    if _time.tzinfo is None:
+        _time = _time.replace(tzinfo=datetime.timezone.utc)
+    return _time
+
+
+def parse_spectra_rows(rows, bins):
+    """ Parse the comma separated values of spectra rows (timestamps removed) into a (rows, bins) float32 array """
+    _spectra = np.empty((len(rows), bins), dtype=np.float32)
+
+    # Convert in blocks of rows, so the intermediate arrays stay small
+    for _start in range(0, len(rows), SPECTRA_PARSE_BLOCK):
+        _block = rows[_start:_start + SPECTRA_PARSE_BLOCK]
+        try:
+            _spectra[_start:_start + len(_block)] = np.loadtxt(_block, dtype=np.float32, delimiter=',', ndmin=2)
+            continue
+        except ValueError:
+            pass
+
+        # Something in this block is malformed, work through it row by row
+        for _i, _row in enumerate(_block):
+            try:
+                _spectra[_start + _i] = np.loadtxt([_row], dtype=np.float32, delimiter=',')
+            except ValueError as e:
+                print(f"Error reading spectra row - {str(e)}")
+                _spectra[_start + _i] = DUMMY_VALUE
+
+    return _spectra
+
+
+def find_spectra_offset(f, start_time, data_start):
+    """ Find the byte offset of the first row at or after start_time in a CSV spectra file opened in binary mode.
+
+    Rows are appended in time order, so this reads back from the end of the file a block
+    at a time, and stops as soon as it reaches a row older than start_time.
+    """
+    f.seek(0, os.SEEK_END)
+    _offset = f.tell()
+    _position = _offset
+    # The start of a row that runs on past the beginning of the block
+    _carry = b''
+
+    while _position > data_start:
+        _read = min(SPECTRA_SEEK_BLOCK, _position - data_start)
+        _position -= _read
+        f.seek(_position)
+        _data = f.read(_read) + _carry
+
+        if _position > data_start:
+            # The first row in the block may have started in the previous one
+            _begin = _data.find(b'\n') + 1
+            if _begin == 0:
+                _carry = _data
+                continue
+            _carry = _data[:_begin]
+        else:
+            _begin = 0
+
+        _starts = [_begin]
+        _index = _data.find(b'\n', _begin)
+        while 0 <= _index < len(_data) - 1:
+            _starts.append(_index + 1)
+            _index = _data.find(b'\n', _index + 1)
+
+        for _start in reversed(_starts):
+            _split = _data.find(b',', _start)
+            try:
+                _time = parse_spectra_time(_data[_start:_split].decode('utf-8'))
+            except (ValueError, OverflowError):
+                # A row that is still being written, or damaged
+                continue
+            if _time < start_time:
+                return _offset
+            _offset = _position + _start
+
+    return _offset
+
+
+def get_index_filename(filename):
+    return filename + SPECTRA_INDEX_EXTENSION
+
+
+def read_spectra_index(filename):
+    """ Read the sidecar index of a CSV spectra file. Returns a structured array, or None if there isn't a usable one """
+    _index_file = get_index_filename(filename)
+    if not os.path.isfile(_index_file) or os.path.getsize(_index_file) % SPECTRA_INDEX_DTYPE.itemsize:
+        return None
+
+    _index = np.fromfile(_index_file, dtype=SPECTRA_INDEX_DTYPE)
+    if len(_index) > 0 and _index['offset'][-1] >= os.path.getsize(filename):
+        # Left over from a different file
+        return None
+    return _index
+
+
+def build_spectra_index(filename):
+    """ (Re)build the sidecar index of a CSV spectra file from scratch """
+    _entries = []
+    _next = None
+
+    _f = open(filename, 'rb')
+    _f.readline() # Skip the header
+    _offset = _f.tell()
+    for line in _f:
+        try:
+            _time = spectra_time_to_epoch(parse_spectra_time(line[:line.find(b',')].decode('utf-8')))
+        except (ValueError, OverflowError):
+            _time = None
+        if _time is not None and (_next is None or _time >= _next):
+            _entries.append((_time, _offset))
+            _next = _time + SPECTRA_INDEX_INTERVAL*1000000
+        _offset += len(line)
+    _f.close()
+
+    # Swap the new index in whole, so readers never see half of it
+    _temp_file = get_index_filename(filename) + ".tmp"
+    np.array(_entries, dtype=SPECTRA_INDEX_DTYPE).tofile(_temp_file)
+    os.replace(_temp_file, get_index_filename(filename))
+
+
+def update_spectra_index(filename, time, offset):
+    """ Add a row just appended to a CSV spectra file to its index, if it is due an entry """
+    _index_file = get_index_filename(filename)
+    if not os.path.isfile(_index_file) or os.path.getsize(_index_file) % SPECTRA_INDEX_DTYPE.itemsize:
+        # Index the rows already in the file first
+        build_spectra_index(filename)
+        return
+
+    _time = spectra_time_to_epoch(time)
+    _f = open(_index_file, 'r+b')
+    _f.seek(0, os.SEEK_END)
+    if _f.tell() >= SPECTRA_INDEX_DTYPE.itemsize:
+        _f.seek(-SPECTRA_INDEX_DTYPE.itemsize, os.SEEK_END)
+        _last = np.frombuffer(_f.read(SPECTRA_INDEX_DTYPE.itemsize), dtype=SPECTRA_INDEX_DTYPE)[0]
+        if _time < _last['time'] + SPECTRA_INDEX_INTERVAL*1000000:
+            _f.close()
+            return
+    _f.write(np.array([(_time, offset)], dtype=SPECTRA_INDEX_DTYPE).tobytes())
+    _f.close()
+
+
+def find_indexed_offset(filename, f, start_time):
+    """ Look up the byte offset of a row at or shortly before start_time in a CSV spectra file's index.
+
+    Returns None if there is no index, or it does not match the file, in which case the caller has to search.
+    """
+    _index = read_spectra_index(filename)
+    if _index is None or len(_index) == 0:
+        return None
+
+    _entry = np.searchsorted(_index['time'], spectra_time_to_epoch(start_time), side='right') - 1
+    if _entry < 0:
+        # Before the first indexed row
+        return 0
+
+    # Make sure the entry really points at the start of the row it was made for
+    _time, _offset = _index[_entry]
+    f.seek(_offset - 1)
+    _line = f.readline()
+    if _line != b'\n':
+        return None
+    _line = f.readline()
+    try:
+        if spectra_time_to_epoch(parse_spectra_time(_line[:_line.find(b',')].decode('utf-8'))) != _time:
+            return None
+    except (ValueError, OverflowError):
+        return None
+
+    return int(_offset)
+
+
+def find_row_offset(filename, f, start_time, data_start):
+    """ Find the byte offset of the first row at or after start_time in a CSV spectra file opened in binary mode """
+    _offset = find_indexed_offset(filename, f, start_time)
+    if _offset is None:
+        _offset = find_spectra_offset(f, start_time, data_start)
+    _offset = max(_offset, data_start)
+
+    # The index only gets us to within an hour, step through the timestamps from there
+    f.seek(_offset)
+    for line in f:
+        try:
+            if parse_spectra_time(line[:line.find(b',')].decode('utf-8')) >= start_time:
+                break
+        except (ValueError, OverflowError):
+            break
+        _offset += len(line)
+
+    return _offset
+
+
+def read_spectra_range(filename, start_time = None, end_time = None):
+    """ Read in the rows of a spectra data file between two times (tz-aware datetimes, None for no limit) """
+    if is_binary_spectra_file(filename):
+        return read_binary_spectra_file(filename, start_time, end_time)
+
     _header = get_file_header(filename)
 
     if _header is None:
         return None
-    
-    _now = datetime.datetime.now(datetime.timezone.utc)
 
-    _f = open(filename,'r')
+    _f = open(filename,'rb')
     _f.readline() # Discard first line
+    _data_start = _f.tell()
+
+    if start_time is not None:
+        # Skip straight to the rows inside the window, rather than parsing the whole history
+        _f.seek(find_row_offset(filename, _f, start_time, _data_start))
     
     _times = []
-    _spectra = []
+    _rows = []
 
     for line in _f:
-        _fields = line.split(',')
-        _time = parse(_fields[0])
+        line = line.decode('utf-8')
+        _split = line.find(',')
+        _time = parse_spectra_time(line[:_split])
 
-        if time_limit:
-            _delta = abs((_now - _time).total_seconds())
-            if _delta > (time_limit*3600):
-                continue
-
-        _spec = [float(i) for i in _fields[1:]]
+        if start_time is not None and _time < start_time:
+            continue
+        if end_time is not None and _time > end_time:
+            # Rows are in time order, there's nothing more for us
+            break
 
-        _spectra.append(_spec)
+        _rows.append(line[_split+1:])
         _times.append(_time)
+
+    _f.close()
     
-    return {'lower': _header[0], 'upper':_header[1], 'time':_times, 'spectra':np.array(_spectra)}
+    return {'lower': _header[0], 'upper':_header[1], 'time':_times, 'spectra':parse_spectra_rows(_rows, int(_header[2]))}
+
+
+def read_spectra_file(filename, time_limit = None):
+    """ Attempt to read in a spectra data file, optionally only the last time_limit hours """
+    if not time_limit:
+        return read_spectra_range(filename)
+
+    _now = datetime.datetime.now(datetime.timezone.utc)
+    _limit = datetime.timedelta(hours=time_limit)
+    return read_spectra_range(filename, _now - _limit, _now + _limit)
+
+
+def open_locked(filename, mode):
+    """ Open a spectra file and take an exclusive lock on it, so appends and clips can't interleave.
+
+    A clip replaces the file while holding the lock, so once we have it, check we
+    haven't been left holding the old copy.
+    """
+    while True:
+        _f = open(filename, mode)
+        fcntl.flock(_f.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.fstat(_f.fileno()).st_ino == os.stat(filename).st_ino:
+                return _f
+        except FileNotFoundError:
+            pass
+        _f.close()
+
+
+def rewrite_file_from(src, filename, data_start, cut):
+    """ Replace a file (open and locked as src) with its first data_start bytes (the header), followed by everything from cut onwards.
+
+    The new file is copied a block at a time to a temporary file and renamed over the
+    original, so a crash part way through leaves the original file intact.
+
+    Returns the new file, still open and locked, so appends to it wait until the caller
+    has finished (e.g. updated the index) and closes it.
+    """
+    _temp_file = filename + ".tmp"
+    _dst = open(_temp_file, 'wb')
+    try:
+        fcntl.flock(_dst.fileno(), fcntl.LOCK_EX)
+        src.seek(0)
+        _dst.write(src.read(data_start))
+        src.seek(cut)
+        shutil.copyfileobj(src, _dst, SPECTRA_COPY_BLOCK)
+
+        _dst.flush()
+        os.fsync(_dst.fileno())
+        shutil.copymode(filename, _temp_file)
+        os.replace(_temp_file, filename)
+        return _dst
+    except BaseException:
+        _dst.close()
+        if os.path.isfile(_temp_file):
+            os.remove(_temp_file)
+        raise
 
 
 def clip_spectra_file(filename, time_limit=48):
-    """ Read in a spectra file, remove any entries outside of a provided time bounds, then write it back out """
+    """ Remove any entries in a spectra file older than time_limit hours """
+    if is_binary_spectra_file(filename):
+        return clip_binary_spectra_file(filename, time_limit)
+
     _header = get_file_header(filename)
 
     if _header is None:
         return None
 
-    _now = datetime.datetime.now(datetime.timezone.utc)    
+    _start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=time_limit)
 
-    # Output data.
-    _outdata = ""
+    # Appends wait until we have swapped the clipped file in
+    _f = open_locked(filename, 'rb')
+    try:
+        # Rows are in time order, so everything before the first row inside the window goes
+        _f.readline()
+        _data_start = _f.tell()
+        _cut = find_row_offset(filename, _f, _start, _data_start)
 
-    _f = open(filename, 'r')
-    _header = _f.readline()
-    _outdata += _header
+        if _cut == _data_start:
+            return
 
-    for line in _f:
-        _fields = line.split(',')
-        _time = parse(_fields[0])
+        _index = read_spectra_index(filename)
+        _new = rewrite_file_from(_f, filename, _data_start, _cut)
 
-        _delta = abs((_now - _time).total_seconds())
-        if _delta > (time_limit*3600):
-            continue
-        else:
-            _outdata += line
-    
-    _f.close()
+        # Appends to the new file wait for its lock, so they can't touch the index until it's been replaced
+        try:
+            # The rows we kept have all moved back by the same amount
+            if _index is not None:
+                _index = _index[_index['offset'] >= _cut]
+                _index['offset'] -= _cut - _data_start
+                _temp_file = get_index_filename(filename) + ".tmp"
+                _index.tofile(_temp_file)
+                os.replace(_temp_file, get_index_filename(filename))
+            else:
+                build_spectra_index(filename)
+        finally:
+            _new.close()
+    finally:
+        _f.close()
+
+
+def clip_binary_spectra_file(filename, time_limit=48):
+    """ Remove any entries of a binary spectra log older than time_limit hours """
+    _f = open_locked(filename, 'rb')
+    try:
+        _data = read_binary_records(filename)
+
+        if _data is None:
+            return None
+        _header, _records = _data
+
+        _start = spectra_time_to_epoch(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=time_limit))
+        _cut = np.searchsorted(_records['time'], _start, side='left')
+        _itemsize = _records.dtype.itemsize
+        del _records
 
-    # Re-open file for writing.
-    _f = open(filename, 'w')
-    _f.write(_outdata)
+        if _cut > 0:
+            rewrite_file_from(_f, filename, BINARY_SPECTRA_HEADER.size, BINARY_SPECTRA_HEADER.size + int(_cut)*_itemsize).close()
+    finally:
+        _f.close()
+
+
+def append_to_binary_file(filename, data):
+    """ Append one record to a binary spectra log, which must already have a header """
+    _record = np.zeros(1, dtype=binary_spectra_dtype(len(data)))
+    _record['time'] = spectra_time_to_epoch(datetime.datetime.now(datetime.timezone.utc))
+
+    _data = np.asarray(data, dtype=np.float64)
+    _spectrum = np.clip(np.round(_data * BINARY_SPECTRA_SCALE), BINARY_SPECTRA_MISSING + 1, 32767)
+    _spectrum[_data <= DUMMY_VALUE] = BINARY_SPECTRA_MISSING
+    _record['spectrum'][0] = _spectrum
+
+    _f = open_locked(filename, 'ab')
+    _f.write(_record.tobytes())
     _f.close()
 
 
@@ -106,7 +527,10 @@ def append_to_file(filename, lower_freq, upper_freq, bins, data):
 
     if not os.path.isfile(filename):
         # File doesn't exist - create it.
-        create_new_file(filename, lower_freq, upper_freq, bins)
+        if is_binary_spectra_file(filename):
+            create_new_binary_file(filename, lower_freq, upper_freq, bins)
+        else:
+            create_new_file(filename, lower_freq, upper_freq, bins)
     else:
         # Attempt to read in the header line.
         _header = get_file_header(filename)
@@ -117,20 +541,30 @@ def append_to_file(filename, lower_freq, upper_freq, bins, data):
         else:
             print("Could not read header!")
             return
+
+    if is_binary_spectra_file(filename):
+        append_to_binary_file(filename, data)
+        return
     
     # Now we can append the line.
-    _output = datetime.datetime.utcnow().isoformat() + "Z"
+    _now = datetime.datetime.now(datetime.timezone.utc)
+    _output = _now.replace(tzinfo=None).isoformat() + "Z"
     for _data in data:
         _output += "," + "%.1f" % _data
     _output += "\n"
 
-    _f = open(filename, 'a')
+    _f = open_locked(filename, 'a')
+    _f.seek(0, os.SEEK_END)
+    _offset = _f.tell()
     _f.write(_output)
+    _f.flush()
+    # Still holding the lock, so the index can't be clipped under us
+    update_spectra_index(filename, _now, _offset)
     _f.close()
 
 
 def append_dummy_entry(filename, lower_freq, upper_freq, bins):
     # Append a dummy entry, indicating we didn't get any data.
-    _data = np.ones(bins)*-999.0
+    _data = np.ones(bins)*DUMMY_VALUE
 
     append_to_file(filename, lower_freq, upper_freq, bins, _data)
\ No newline at end of file
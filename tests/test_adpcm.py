@@ -0,0 +1,80 @@
+#
+#   Correctness tests for the compressed (ADPCM) waterfall decoder.
+#
+#   The fixtures in data/wf_adpcm_frames.npz are complete W/F messages (header and
+#   compressed body) with the uint8 lines they must decode to. They were made with our
+#   own IMA ADPCM encoder, not captured from a Kiwi, so they check the decoder against
+#   the standard algorithm rather than against a server's output.
+#
+import os.path
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kiwi_helpers import *
+from kiwi_helpers import _ADPCM_INDEX_ADJUST, _ADPCM_STEP_SIZE
+
+FRAMES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "wf_adpcm_frames.npz")
+BINS = 1024
+
+
+def reference_decode(data, bins):
+    """ Plain sample-by-sample IMA ADPCM decoder, to check the table-driven one against """
+    _index = 0
+    _prev = 0
+    _values = []
+    for _byte in data:
+        for _code in (_byte & 0x0f, _byte >> 4):
+            _step = _ADPCM_STEP_SIZE[_index]
+            _diff = _step >> 3
+            if _code & 1:
+                _diff += _step >> 2
+            if _code & 2:
+                _diff += _step >> 1
+            if _code & 4:
+                _diff += _step
+            if _code & 8:
+                _diff = -_diff
+            _prev = min(max(_prev + _diff, -32768), 32767)
+            _index = min(max(_index + _ADPCM_INDEX_ADJUST[_code], 0), len(_ADPCM_STEP_SIZE) - 1)
+            _values.append(_prev)
+    return np.clip(_values[ADPCM_PAD:ADPCM_PAD + bins], 0, 255).astype(np.uint8)
+
+
+def decode_message(message):
+    _message = memoryview(message.tobytes())
+    _header = decode_waterfall_header(_message[:WF_HEADER_LEN])
+    return _header, decode_waterfall_adpcm(_message[WF_HEADER_LEN:], BINS)
+
+
+def test_encoded_line():
+    _frames = np.load(FRAMES)
+    _header, _line = decode_message(_frames['line_message'])
+    assert _header['seq'] == 1234
+    assert np.array_equal(_line, _frames['line_expected'])
+
+
+def test_saturated_predictor():
+    """ The predictor hits +32767 and has to clamp there, or the rest of the line comes out wrong """
+    _frames = np.load(FRAMES)
+    _header, _line = decode_message(_frames['saturated_message'])
+    assert np.array_equal(_line, _frames['saturated_expected'])
+    # The line comes back down to the noise floor after saturating
+    assert _line[0] == 255 and _line[-1] < 255
+
+
+def test_matches_reference():
+    _rng = np.random.default_rng(1)
+    for _i in range(20):
+        _data = _rng.integers(0, 256, (BINS + ADPCM_PAD + 1)//2, dtype=np.uint8).tobytes()
+        assert np.array_equal(decode_waterfall_adpcm(_data, BINS), reference_decode(_data, BINS))
+
+
+def test_short_line():
+    try:
+        decode_waterfall_adpcm(bytes(100), BINS)
+    except ValueError:
+        return
+    assert False, "short line was not rejected"
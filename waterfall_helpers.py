@@ -0,0 +1,203 @@
+#
+#   Helper functions and classes to reduce waterfall lines as they arrive.
+#
+import numpy as np
+
+# typical Kiwi wf cal - NEED TO REVISIT THIS
+WF_CAL = -13
+
+
+def waterfall_to_dbm(spectrum):
+    """ Convert raw uint8 waterfall data to dBm """
+    #return spectrum-255 # mirror dBs
+    return -(255.0 - spectrum) + WF_CAL
+
+
+# Raw waterfall value (0-255) to power in mW
+RAW_TO_MW = 10**(waterfall_to_dbm(np.arange(256))/10.0)
+
+
+class WaterfallHistogram(object):
+    """ Per-bin histogram of raw uint8 waterfall values (bins x 256 counts).
+
+    As the waterfall data can only take 256 values, this gives exact time-percentiles
+    for each bin, without keeping the lines themselves.
+    """
+
+    def __init__(self, bins):
+        self.bins = bins
+        self.count = 0
+        self._hist = np.zeros((bins, 256), dtype=np.uint32)
+        # Offset of each bin's row in the flattened histogram
+        self._flat = self._hist.reshape(-1)
+        self._offsets = np.arange(bins, dtype=np.intp) * 256
+
+    def add(self, spectrum):
+        """ Add one raw uint8 waterfall line """
+        # Every bin appears exactly once per line, so there are no repeated
+        # indices and a plain fancy-index increment is a valid scatter-add.
+        self._flat[self._offsets + spectrum] += 1
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+        self._hist[:] = 0
+
+    def percentile_raw(self, q):
+        """ q-th percentile over time for each bin, in raw units.
+
+        Uses the same linear interpolation between order statistics as np.percentile.
+        """
+        if self.count == 0:
+            return np.full(self.bins, np.nan)
+
+        _cdf = np.cumsum(self._hist, axis=1)
+        _rank = (q/100.0) * (self.count - 1)
+        _lower = int(np.floor(_rank))
+        _upper = int(np.ceil(_rank))
+
+        # The k-th order statistic (0 based) is the first value whose cumulative count exceeds k
+        _lower_val = np.count_nonzero(_cdf <= _lower, axis=1)
+        _upper_val = np.count_nonzero(_cdf <= _upper, axis=1)
+
+        return _lower_val + (_upper_val - _lower_val)*(_rank - _lower)
+
+    def percentile(self, q):
+        """ q-th percentile over time for each bin, in dBm """
+        return waterfall_to_dbm(self.percentile_raw(q))
+
+
+class WaterfallAccumulator(object):
+    """ Folds raw uint8 waterfall lines into running per-bin sum, max, min and count.
+
+    Memory use is O(bins) no matter how many lines are added.
+    """
+
+    def __init__(self, bins, histogram=False, linear=False, variance=False):
+        self.bins = bins
+        self.count = 0
+        self._sum = np.zeros(bins, dtype=np.uint64)
+        self._max = np.zeros(bins, dtype=np.uint8)
+        self._min = np.full(bins, 255, dtype=np.uint8)
+
+        # Optionally keep a running sum of squares, for the spread of each bin over time
+        self._sumsq = np.zeros(bins, dtype=np.uint64) if variance else None
+        self._square = np.zeros(bins, dtype=np.uint32) if variance else None
+
+        # Optionally keep a running sum of linear power (mW), for averaging in the power domain
+        self._power_sum = np.zeros(bins) if linear else None
+        self._power_sumsq = np.zeros(bins) if linear and variance else None
+
+        # Optionally keep a per-bin histogram for time-percentiles
+        self.histogram = WaterfallHistogram(bins) if histogram else None
+
+    def add(self, spectrum):
+        """ Add one raw uint8 waterfall line """
+        np.add(self._sum, spectrum, out=self._sum)
+        np.maximum(self._max, spectrum, out=self._max)
+        np.minimum(self._min, spectrum, out=self._min)
+        if self._power_sum is not None:
+            _power = RAW_TO_MW[spectrum]
+            self._power_sum += _power
+            if self._power_sumsq is not None:
+                self._power_sumsq += _power * _power
+        if self._sumsq is not None:
+            np.multiply(spectrum, spectrum, out=self._square, dtype=np.uint32)
+            np.add(self._sumsq, self._square, out=self._sumsq)
+        if self.histogram:
+            self.histogram.add(spectrum)
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+        self._sum[:] = 0
+        self._max[:] = 0
+        self._min[:] = 255
+        if self._power_sum is not None:
+            self._power_sum[:] = 0
+        if self._power_sumsq is not None:
+            self._power_sumsq[:] = 0
+        if self._sumsq is not None:
+            self._sumsq[:] = 0
+        if self.histogram:
+            self.histogram.reset()
+
+    def mean(self):
+        """ Average over time, in dBm """
+        return waterfall_to_dbm(self._sum / max(self.count, 1))
+
+    def std_error(self, linear=False):
+        """ Standard error of the mean of each bin, in dB. Requires variance=True
+
+        With linear=True this is the standard error of mean_power() instead, which also requires linear=True.
+        """
+        if self._sumsq is None:
+            raise ValueError("Accumulator was created without variance sums")
+        if self.count < 2:
+            return np.full(self.bins, np.inf)
+        if linear:
+            if self._power_sumsq is None:
+                raise ValueError("Accumulator was created without linear power sums")
+            _mean = self._power_sum / self.count
+            _var = (self._power_sumsq - self.count*_mean*_mean) / (self.count - 1)
+            # Relative error of the mean power, converted to dB
+            return (10/np.log(10)) * np.sqrt(np.maximum(_var, 0) / self.count) / _mean
+        _mean = self._sum / self.count
+        _var = (self._sumsq - self.count*_mean*_mean) / (self.count - 1)
+        return np.sqrt(np.maximum(_var, 0) / self.count)
+
+    def mean_power(self):
+        """ Average over time taken in the linear power domain, in dBm. Requires linear=True """
+        if self._power_sum is None:
+            raise ValueError("Accumulator was created without linear power sums")
+        return 10*np.log10(self._power_sum / max(self.count, 1))
+
+    def peak_power_sum(self):
+        """ Total power of the peak spectrum, in dBm """
+        return 10*np.log10(np.sum(RAW_TO_MW[self._max]))
+
+    def max(self):
+        """ Peak values over time, in dBm """
+        return waterfall_to_dbm(self._max)
+
+    def min(self):
+        """ Minimum values over time, in dBm """
+        return waterfall_to_dbm(self._min)
+
+    def percentile(self, q):
+        """ q-th percentile over time for each bin, in dBm. Requires histogram=True """
+        if self.histogram is None:
+            raise ValueError("Accumulator was created without a histogram")
+        return self.histogram.percentile(q)
+
+
+# Two-sided 95% confidence interval, in standard errors
+CI_95 = 1.96
+
+
+def snr_confidence(accumulator, percentiles=(50, 95), neighbourhood=0.02, linear=False):
+    """ 95% confidence half-widths (dB) of the median / p95 (across bins) of the average spectrum.
+    Requires an accumulator created with variance=True.
+
+    The average spectrum is the one write_results saves: the dB mean, or with linear=True
+    the mean taken in the power domain. The uncertainty of a percentile of it is taken as
+    the mean standard error of the bins whose averages sit around that percentile.
+    """
+    _mean = accumulator.mean_power() if linear else accumulator.mean()
+    _se = accumulator.std_error(linear)
+
+    _order = np.argsort(_mean)
+    _half = max(1, int(neighbourhood * accumulator.bins / 2))
+
+    _widths = []
+    for _q in percentiles:
+        _rank = int(round(_q/100.0 * (accumulator.bins - 1)))
+        _near = _order[max(0, _rank - _half):_rank + _half + 1]
+        _widths.append(CI_95 * np.mean(_se[_near]))
+
+    return _widths
+
+
+def snr_converged(accumulator, tolerance, linear=False):
+    """ True once the median and p95 confidence half-widths are both within tolerance (dB) """
+    return max(snr_confidence(accumulator, linear=linear)) <= tolerance
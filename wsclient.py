@@ -2,6 +2,7 @@
 Modified echo client from the pywebsocket examples
 """
 
+import asyncio
 import base64
 import logging
 import os
@@ -55,19 +56,72 @@ def _format_host_header(host, port, secure):
     return '%s: %s\r\n' % (common.HOST_HEADER, hostport)
 
 
-def _receive_bytes(socket, length):
-    bytes = []
-    remaining = length
-    while remaining > 0:
-        received_bytes = socket.recv(remaining)
+# Bytes requested per recv while reading the opening handshake response
+_HANDSHAKE_READ_SIZE = 4096
+
+# Give up on a response header longer than this
+_MAX_RESPONSE_HEADER_SIZE = 65536
+
+
+def _receive_response_header(socket):
+    """Reads the opening handshake response up to and including the empty
+    line, in bulk. Returns (header, leftover) where leftover holds any bytes
+    the server sent after the header, i.e. the start of the WebSocket frames.
+    """
+
+    received = bytearray()
+    while True:
+        # The terminator may straddle two reads, so look back a little.
+        search_start = max(0, len(received) - 3)
+        received_bytes = socket.recv(_HANDSHAKE_READ_SIZE)
         if not received_bytes:
             raise IOError(
-                'Connection closed before receiving requested length '
-                '(requested %d bytes but received only %d bytes)' %
-                (length, length - remaining))
-        bytes.append(received_bytes)
-        remaining -= len(received_bytes)
-    return bytearray().join(bytes).decode('utf-8')
+                'Connection closed before receiving the response header '
+                '(received %d bytes)' % len(received))
+        received += received_bytes
+
+        end = received.find(b'\r\n\r\n', search_start)
+        if end >= 0:
+            end += 4
+            return bytes(received[:end]), bytes(received[end:])
+        if len(received) > _MAX_RESPONSE_HEADER_SIZE:
+            raise ClientHandshakeError(
+                'Response header longer than %d bytes' %
+                _MAX_RESPONSE_HEADER_SIZE)
+
+
+def _parse_status_line(status_line):
+    """Returns the status code of an HTTP Status-Line as a string."""
+
+    m = re.match(r'HTTP/\d+\.\d+ (\d\d\d) .*\r\n', status_line)
+    if m is None:
+        raise ClientHandshakeError('Wrong status line format: %r' % status_line)
+    return m.group(1)
+
+
+def parse_response_header(data):
+    """Parses a complete opening handshake response (everything up to and
+    including the empty line) and returns the status code and a dictionary
+    mapping lower case header names to lists of values.
+
+    Raises:
+        ClientHandshakeError: the response is malformed.
+    """
+
+    lines = data.decode('utf-8').split('\r\n')
+    if len(lines) < 3 or lines[-1] != '' or lines[-2] != '':
+        raise ClientHandshakeError('Response header is not terminated by an empty line')
+    status_code = _parse_status_line(lines[0] + '\r\n')
+
+    fields = {}
+    for line in lines[1:-2]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ClientHandshakeError('Malformed header line %r' % line)
+        if '\n' in line:
+            raise ClientHandshakeError('Unexpected LF in header line %r' % line)
+        fields.setdefault(name.lower(), []).append(value.lstrip(' '))
+    return status_code, fields
 
 
 def _get_mandatory_header(fields, name):
@@ -116,79 +170,6 @@ class ClientHandshakeBase(object):
     def __init__(self):
         self._logger = util.get_class_logger(self)
 
-    def _read_fields(self):
-        # 4.1 32. let /fields/ be a list of name-value pairs, initially empty.
-        fields = {}
-        while True:  # "Field"
-            # 4.1 33. let /name/ and /value/ be empty byte arrays
-            name = ''
-            value = ''
-            # 4.1 34. read /name/
-            name = self._read_name()
-            if name is None:
-                break
-            # 4.1 35. read spaces
-            # TODO(tyoshino): Skip only one space as described in the spec.
-            ch = self._skip_spaces()
-            # 4.1 36. read /value/
-            value = self._read_value(ch)
-            # 4.1 37. read a byte from the server
-            ch = _receive_bytes(self._socket, 1)
-            if ch != '\n':  # 0x0A
-                raise ClientHandshakeError(
-                    'Expected LF but found %r while reading value %r for '
-                    'header %r' % (ch, value, name))
-            self._logger.debug('Received %r header', name)
-            # 4.1 38. append an entry to the /fields/ list that has the name
-            # given by the string obtained by interpreting the /name/ byte
-            # array as a UTF-8 stream and the value given by the string
-            # obtained by interpreting the /value/ byte array as a UTF-8 byte
-            # stream.
-            fields.setdefault(name, []).append(value)
-            # 4.1 39. return to the "Field" step above
-        return fields
-
-    def _read_name(self):
-        # 4.1 33. let /name/ be empty byte arrays
-        name = ''
-        while True:
-            # 4.1 34. read a byte from the server
-            ch = _receive_bytes(self._socket, 1)
-            if ch == '\r':  # 0x0D
-                return None
-            elif ch == '\n':  # 0x0A
-                raise ClientHandshakeError(
-                    'Unexpected LF when reading header name %r' % name)
-            elif ch == ':':  # 0x3A
-                return name
-            elif ch >= 'A' and ch <= 'Z':  # Range 0x31 to 0x5A
-                ch = chr(ord(ch) + 0x20)
-                name += ch
-            else:
-                name += ch
-
-    def _skip_spaces(self):
-        # 4.1 35. read a byte from the server
-        while True:
-            ch = _receive_bytes(self._socket, 1)
-            if ch == ' ':  # 0x20
-                continue
-            return ch
-
-    def _read_value(self, ch):
-        # 4.1 33. let /value/ be empty byte arrays
-        value = ''
-        # 4.1 36. read a byte from server.
-        while True:
-            if ch == '\r':  # 0x0D
-                return value
-            elif ch == '\n':  # 0x0A
-                raise ClientHandshakeError(
-                    'Unexpected LF when reading header value %r' % value)
-            else:
-                value += ch
-            ch = _receive_bytes(self._socket, 1)
-
 
 def _get_permessage_deflate_framer(extension_response):
     """Validate the response and return a framer object using the parameters in
@@ -255,11 +236,10 @@ class ClientHandshakeProcessor(ClientHandshakeBase):
 
         self._logger = util.get_class_logger(self)
 
-    def handshake(self, resource):
-        """Performs opening handshake on the specified socket.
-
-        Raises:
-            ClientHandshakeError: handshake failed.
+    def build_request(self, resource):
+        """Builds the opening handshake request for the specified resource and
+        returns it as bytes. A fresh Sec-WebSocket-Key is generated on every
+        call.
         """
 
         request_line = _build_method_line(resource)
@@ -291,41 +271,82 @@ class ClientHandshakeProcessor(ClientHandshakeBase):
         if len(extensions_to_request) != 0:
             fields.append('%s: %s\r\n' % (common.SEC_WEBSOCKET_EXTENSIONS_HEADER, common.format_extensions(extensions_to_request)))
 
-        self._socket.sendall(request_line)
-        for field in fields:
-            self._socket.sendall(field.encode())
-        self._socket.sendall(b'\r\n')
-
-        self._logger.debug('Sent client\'s opening handshake headers: %r', fields)
-        self._logger.debug('Start reading Status-Line')
-
-        status_line = ''
-        while True:
-            ch = _receive_bytes(self._socket, 1)
-            status_line += ch
-            if ch == '\n':
-                break
-
-        m = re.match('HTTP/\\d+\.\\d+ (\\d\\d\\d) .*\r\n', status_line)
-        if m is None:
-            raise ClientHandshakeError('Wrong status line format: %r' % status_line)
-        status_code = m.group(1)
+        self._logger.debug('Client\'s opening handshake headers: %r', fields)
+
+        return request_line + ''.join(fields).encode() + b'\r\n'
+
+    def handshake(self, resource):
+        """Performs opening handshake on the specified socket.
+
+        The response is read in bulk, so the server may already have sent
+        the first frames along with it. These bytes are returned, and must
+        be handed on to the connection (see ClientRequest).
+
+        Raises:
+            ClientHandshakeError: handshake failed.
+        """
+
+        self._socket.sendall(self.build_request(resource))
+
+        self._logger.debug('Sent client\'s opening handshake')
+
+        header, leftover = _receive_response_header(self._socket)
+        self.process_response(header)
+
+        return leftover
+
+    async def handshake_async(self, reader, writer, resource):
+        """Performs opening handshake over an asyncio StreamReader /
+        StreamWriter pair. Any frames the server sends along with the
+        response are left in reader.
+
+        Raises:
+            ClientHandshakeError: handshake failed.
+        """
+
+        writer.write(self.build_request(resource))
+        await writer.drain()
+
+        self._logger.debug('Sent client\'s opening handshake')
+
+        try:
+            header = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            raise ClientHandshakeError('Response header too long')
+        except asyncio.IncompleteReadError as e:
+            raise IOError(
+                'Connection closed before receiving the response header '
+                '(received %d bytes)' % len(e.partial))
+
+        self.process_response(header)
+
+    def process_response(self, header):
+        """Validates a complete opening handshake response (everything up to
+        and including the empty line) against the request built by
+        build_request. Used directly when the response is read by the caller,
+        e.g. from a non-blocking socket.
+
+        Raises:
+            ClientHandshakeError: handshake failed.
+        """
+
+        status_code, fields = parse_response_header(header)
         if status_code != '101':
-            self._logger.debug('Unexpected status code %s with following headers: %r', status_code, self._read_fields())
+            self._logger.debug('Unexpected status code %s with following headers: %r', status_code, fields)
             raise ClientHandshakeError('Expected HTTP status code 101 but found %r' % status_code)
 
-        self._logger.debug('Received valid Status-Line')
-        self._logger.debug('Start reading headers until we see an empty line')
+        self._logger.debug('Received valid Status-Line and headers')
 
-        fields = self._read_fields()
+        self.check_response(fields)
 
-        ch = _receive_bytes(self._socket, 1)
-        if ch != '\n':  # 0x0A
-            raise ClientHandshakeError(
-                'Expected LF but found %r while reading value %r for header '
-                'name %r' % (ch, value, name))
+    def check_response(self, fields):
+        """Validates the headers of the server's opening handshake response
+        against the request built by build_request.
+
+        Raises:
+            ClientHandshakeError: handshake failed.
+        """
 
-        self._logger.debug('Received an empty line')
         self._logger.debug('Server\'s opening handshake headers: %r', fields)
 
         _validate_mandatory_header(fields, common.UPGRADE_HEADER, common.WEBSOCKET_UPGRADE_TYPE, False)
@@ -399,8 +420,11 @@ class ClientConnection(object):
     mp_conn object.
     """
 
-    def __init__(self, socket):
+    def __init__(self, socket, pending=b''):
         self._socket = socket
+        # Bytes already read from the socket (e.g. during the handshake),
+        # returned before anything else is read from it.
+        self._pending = pending
 
     def write(self, data):
         try:
@@ -409,8 +433,20 @@ class ClientConnection(object):
             logging.debug('ClientConnection write error: "%s"' % e)
 
     def read(self, n):
+        if self._pending:
+            data = self._pending[:n]
+            self._pending = self._pending[n:]
+            return data
         return self._socket.recv(n)
 
+    def read_into(self, buffer):
+        if self._pending:
+            n = min(len(buffer), len(self._pending))
+            buffer[:n] = self._pending[:n]
+            self._pending = self._pending[n:]
+            return n
+        return self._socket.recv_into(buffer)
+
     def get_remote_addr(self):
         return self._socket.getpeername()
     remote_addr = property(get_remote_addr)
@@ -421,10 +457,10 @@ class ClientRequest(object):
     functions that expect a mp_request object.
     """
 
-    def __init__(self, socket):
+    def __init__(self, socket, pending=b''):
         self._logger = util.get_class_logger(self)
 
         self._socket = socket
-        self.connection = ClientConnection(socket)
+        self.connection = ClientConnection(socket, pending)
 
 